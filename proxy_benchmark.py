@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for proxy_server.py hot paths
+Runs the proxy in-process against a simulated Ollama upstream, so the numbers
+measure proxy overhead only (no GPU, no real network).
+
+Usage: python proxy_benchmark.py stream --tokens 2000 --streams 20
+       python proxy_benchmark.py json --context 100000 --requests 200
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from typing import Dict, List
+
+import httpx
+
+import proxy_server
+
+def fake_ollama(tokens: int) -> httpx.MockTransport:
+    """Upstream that streams one NDJSON chunk per token, like Ollama does"""
+    # Pre-encoded so the simulated upstream costs as little CPU as possible
+    chunks = [(json.dumps({"model": "bench", "created_at": "2024-01-01T00:00:00Z",
+                           "response": f"tok{i} ", "done": False}) + "\n").encode() for i in range(tokens)]
+    chunks.append((json.dumps({"model": "bench", "response": "", "done": True,
+                               "eval_count": tokens, "eval_duration": 1_000_000_000}) + "\n").encode())
+
+    async def token_stream():
+        for chunk in chunks:
+            yield chunk
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path != "/api/generate":
+            return httpx.Response(404)
+        return httpx.Response(200, content=token_stream(), headers={"content-type": "application/x-ndjson"})
+
+    return httpx.MockTransport(handler)
+
+async def run_streams(mode: str, fmt: str, tokens: int, streams: int) -> Dict[str, float]:
+    """Push `streams` streamed /generate calls through the proxy and measure throughput and CPU"""
+    proxy_server.STREAM_MODE = mode
+    proxy_server.upstream.client = httpx.AsyncClient(transport=fake_ollama(tokens))
+    headers = {"accept": "application/x-ndjson"} if fmt == "ndjson" else {}
+    transport = httpx.ASGITransport(app=proxy_server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://proxy") as client:
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        for i in range(streams):
+            response = await client.post("/generate", headers=headers,
+                                         json={"model": "bench", "prompt": f"prompt {i}", "stream": True})
+            response.raise_for_status()
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+    await proxy_server.upstream.client.aclose()
+    return {
+        "tokens_per_sec": tokens * streams / wall,
+        "cpu_ms_per_stream": cpu * 1000 / streams,
+        "cpu_us_per_token": cpu * 1e6 / (tokens * streams),
+    }
+
+def fake_ollama_json(context: int, words: int) -> tuple:
+    """Upstream returning one large non-streamed /generate body; returns (transport, body size)"""
+    body = json.dumps({"model": "bench", "created_at": "2024-01-01T00:00:00Z",
+                       "response": "word " * words, "done": True, "done_reason": "stop",
+                       "context": list(range(context)), "total_duration": 2_000_000_000,
+                       "load_duration": 1_000_000, "prompt_eval_count": 10, "prompt_eval_duration": 10_000_000,
+                       "eval_count": words, "eval_duration": 1_000_000_000}).encode()
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path != "/api/generate":
+            return httpx.Response(404)
+        return httpx.Response(200, content=body, headers={"content-type": "application/json"})
+
+    return httpx.MockTransport(handler), len(body)
+
+async def run_json(passthrough: bool, context: int, words: int, requests: int) -> Dict[str, float]:
+    """Send `requests` non-streamed /generate calls through the proxy and measure CPU per request"""
+    proxy_server.JSON_PASSTHROUGH = passthrough
+    transport, size = fake_ollama_json(context, words)
+    proxy_server.upstream.client = httpx.AsyncClient(transport=transport)
+    asgi = httpx.ASGITransport(app=proxy_server.app)
+    async with httpx.AsyncClient(transport=asgi, base_url="http://proxy") as client:
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        for i in range(requests):
+            response = await client.post("/generate", json={"model": "bench", "prompt": f"prompt {i}"})
+            response.raise_for_status()
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+    await proxy_server.upstream.client.aclose()
+    return {"body_kb": size / 1024, "requests_per_sec": requests / wall, "cpu_ms_per_request": cpu * 1000 / requests}
+
+def print_table(title: str, rows: List[tuple]):
+    print(f"\n📊 {title}")
+    print(f"{'mode':<10} {'format':<8} {'tokens/s':>12} {'CPU ms/stream':>14} {'CPU us/token':>13}")
+    for mode, fmt, result in rows:
+        print(f"{mode:<10} {fmt:<8} {result['tokens_per_sec']:>12,.0f} "
+              f"{result['cpu_ms_per_stream']:>14.2f} {result['cpu_us_per_token']:>13.2f}")
+
+async def bench_stream(args):
+    """Compare the lines, raw and batched streaming relays"""
+    proxy_server.RATE_LIMIT_ENABLED = False
+    proxy_server.COALESCE_MODE = "off"
+    rows = []
+    for fmt in ("sse", "ndjson"):
+        for mode in ("lines", "raw", "batched"):
+            await run_streams(mode, fmt, args.tokens, 2)  # warm-up
+            rows.append((mode, fmt, await run_streams(mode, fmt, args.tokens, args.streams)))
+    print_table(f"Streaming relay, {args.streams} streams x {args.tokens} tokens", rows)
+
+async def bench_json(args):
+    """Compare relaying non-streamed bodies unchanged with decoding and re-encoding them"""
+    proxy_server.RATE_LIMIT_ENABLED = False
+    proxy_server.COALESCE_MODE = "off"
+    print(f"\n📊 Non-streamed responses, {args.requests} requests (orjson: {'yes' if proxy_server.orjson else 'no'})")
+    print(f"{'mode':<13} {'context':>9} {'body KB':>9} {'req/s':>9} {'CPU ms/req':>11}")
+    for context in (1000, args.context // 10, args.context):
+        for label, passthrough in (("re-encode", False), ("pass-through", True)):
+            await run_json(passthrough, context, args.words, 5)  # warm-up
+            result = await run_json(passthrough, context, args.words, args.requests)
+            print(f"{label:<13} {context:>9,} {result['body_kb']:>9,.0f} "
+                  f"{result['requests_per_sec']:>9,.0f} {result['cpu_ms_per_request']:>11.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark proxy_server.py hot paths")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    stream = subparsers.add_parser("stream", help="Streaming relay modes (PROXY_STREAM_MODE)")
+    stream.add_argument("--tokens", type=int, default=2000, help="Tokens per stream")
+    stream.add_argument("--streams", type=int, default=20, help="Streams per mode")
+    stream.set_defaults(func=bench_stream)
+
+    json_bench = subparsers.add_parser("json", help="Non-streamed JSON relay (PROXY_JSON_PASSTHROUGH)")
+    json_bench.add_argument("--context", type=int, default=100_000, help="Largest context array in the response")
+    json_bench.add_argument("--words", type=int, default=2000, help="Words of generated text per response")
+    json_bench.add_argument("--requests", type=int, default=200, help="Requests per configuration")
+    json_bench.set_defaults(func=bench_json)
+
+    args = parser.parse_args()
+    asyncio.run(args.func(args))
+
+if __name__ == "__main__":
+    main()
@@ -2,19 +2,2825 @@
 """
 FastAPI proxy server for Ollama
 Provides additional features like authentication, logging, rate limiting, etc.
+
+Set PROXY_API_KEYS to require `Authorization: Bearer <key>` (or X-API-Key)
+on generation endpoints.
 """
 
-from fastapi import FastAPI, HTTPException, Depends, Request
-from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, HTMLResponse
-from pydantic import BaseModel
-import httpx
-import json
-import time
-from typing import Optional, List, Dict, Any
-import asyncio
+from fastapi import FastAPI, HTTPException, Depends, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, HTMLResponse, JSONResponse, PlainTextResponse, Response
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
+from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import contextlib
+import hashlib
+import heapq
+import httpx
+import itertools
+import json
+import math
+import os
+import sqlite3
+import time
+import uuid
+from urllib.parse import quote
+from typing import Optional, List, Dict, Any, AsyncIterator, Awaitable, Callable, ClassVar, Literal, Union
+import asyncio
+import random
+
+try:
+    import orjson  # optional: several times faster parsing of upstream JSON
+except ImportError:
+    orjson = None
+
+try:
+    import numpy as np  # optional: compact embedding vector cache
+except ImportError:
+    np = None
+
+def json_loads(data):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+def connect_sqlite(path: str) -> sqlite3.Connection:
+    """SQLite connection that tolerates other worker processes using the same file"""
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = sqlite3.connect(path, check_same_thread=False, timeout=5)
+    db.execute("PRAGMA journal_mode=WAL")
+    return db
+
+# Configuration
+OLLAMA_BASE_URL = "http://localhost:11434"
+REQUEST_TIMEOUT = 300
+
+# Backends to balance across (comma separated); defaults to OLLAMA_BASE_URL
+OLLAMA_BACKENDS = [
+    url.strip().rstrip("/")
+    for url in os.environ.get("OLLAMA_BACKENDS", OLLAMA_BASE_URL).split(",")
+    if url.strip()
+]
+LB_STRATEGY = os.environ.get("PROXY_LB_STRATEGY", "least_outstanding")  # or "p2c"
+LB_FAILURE_THRESHOLD = int(os.environ.get("PROXY_LB_FAILURE_THRESHOLD", "3"))
+LB_PROBE_INTERVAL = float(os.environ.get("PROXY_LB_PROBE_INTERVAL", "15"))
+
+# /models is served from cache: refreshed in the background after the TTL, stale data served up to MAX_STALE
+MODELS_CACHE_TTL = float(os.environ.get("PROXY_MODELS_CACHE_TTL", "10"))
+MODELS_CACHE_MAX_STALE = float(os.environ.get("PROXY_MODELS_CACHE_MAX_STALE", "300"))
+
+# Multi-worker mode: a SQLite file through which workers share stats, rate-limit buckets and cache entries
+SHARED_STATE_DB = os.environ.get("PROXY_SHARED_STATE_DB", "")
+SHARED_STATS_INTERVAL = float(os.environ.get("PROXY_SHARED_STATS_INTERVAL", "2"))
+
+# Response cache for deterministic requests (temperature 0 or fixed seed)
+RESPONSE_CACHE_ENABLED = os.environ.get("PROXY_CACHE_ENABLED", "0").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("PROXY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESPONSE_CACHE_TTL = float(os.environ.get("PROXY_CACHE_TTL", "3600"))
+RESPONSE_CACHE_DB = os.environ.get("PROXY_CACHE_DB", SHARED_STATE_DB)  # SQLite path for the on-disk tier
+
+# Coalescing of concurrent identical requests: "all", "deterministic" or "off"
+COALESCE_MODE = os.environ.get("PROXY_COALESCE", "all").lower()
+
+# Admission control in front of the upstream
+ADMISSION_GLOBAL_LIMIT = int(os.environ.get("PROXY_MAX_CONCURRENT", "32"))
+ADMISSION_MODEL_LIMIT = int(os.environ.get("PROXY_MAX_CONCURRENT_PER_MODEL", "8"))
+ADMISSION_QUEUE_DEPTH = int(os.environ.get("PROXY_QUEUE_DEPTH", "256"))
+ADMISSION_QUEUE_POLICY = os.environ.get("PROXY_QUEUE_POLICY", "fifo").lower()  # or "priority"
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("PROXY_QUEUE_TIMEOUT", "120"))
+
+# Authentication and rate limiting
+API_KEYS = {k.strip() for k in os.environ.get("PROXY_API_KEYS", "").split(",") if k.strip()}
+RATE_LIMIT_ENABLED = os.environ.get("PROXY_RATE_LIMIT", "1").lower() in ("1", "true", "yes")
+RATE_LIMIT_IP_RATE = float(os.environ.get("PROXY_RATE_LIMIT_IP_RPS", "5"))
+RATE_LIMIT_IP_BURST = float(os.environ.get("PROXY_RATE_LIMIT_IP_BURST", "20"))
+RATE_LIMIT_KEY_RATE = float(os.environ.get("PROXY_RATE_LIMIT_KEY_RPS", "10"))
+RATE_LIMIT_KEY_BURST = float(os.environ.get("PROXY_RATE_LIMIT_KEY_BURST", "40"))
+TOKEN_QUOTA_PER_MINUTE = float(os.environ.get("PROXY_TOKEN_QUOTA_PER_MINUTE", "0"))  # 0 = unlimited
+RATE_LIMIT_BACKEND = os.environ.get("PROXY_RATE_LIMIT_BACKEND", "memory")  # or a redis:// or sqlite:/// URL
+
+# Number of recent requests kept for /stats
+REQUEST_LOG_SIZE = int(os.environ.get("PROXY_REQUEST_LOG_SIZE", "100000"))
+
+# Streaming relay: "lines" decodes and re-frames each line, "raw" relays upstream
+# bytes untouched (SSE framing done on bytes), "batched" additionally writes every
+# line already available in one SSE write
+STREAM_MODE = os.environ.get("PROXY_STREAM_MODE", "raw").lower()
+
+# Model residency: pinned models are pre-loaded and kept resident, others follow PROXY_KEEP_ALIVE
+PINNED_MODELS = [m.strip() for m in os.environ.get("PROXY_PINNED_MODELS", "").split(",") if m.strip()]
+MODEL_KEEP_ALIVE = os.environ.get("PROXY_KEEP_ALIVE", "")  # e.g. "10m"; empty leaves Ollama's default
+MODEL_MEMORY_BUDGET = int(os.environ.get("PROXY_MODEL_MEMORY_BUDGET", "0"))  # bytes per backend, 0 = unlimited
+RESIDENCY_POLL_INTERVAL = float(os.environ.get("PROXY_RESIDENCY_POLL_INTERVAL", "15"))
+COLD_LOAD_THRESHOLD = float(os.environ.get("PROXY_COLD_LOAD_THRESHOLD", "0.5"))  # load_duration seconds
+
+# Prompt token counting and context window checks
+TOKEN_COUNT_MODE = os.environ.get("PROXY_TOKEN_COUNT", "approx").lower()  # "approx", "exact" or "off"
+TOKEN_CACHE_SIZE = int(os.environ.get("PROXY_TOKEN_CACHE_SIZE", "10000"))  # memoized exact counts
+DEFAULT_NUM_CTX = int(os.environ.get("PROXY_DEFAULT_NUM_CTX", "2048"))  # when neither request nor Modelfile sets num_ctx
+CONTEXT_OVERFLOW = os.environ.get("PROXY_CONTEXT_OVERFLOW", "off").lower()  # "reject", "trim" or "off"
+
+# Micro-batching of short /generate requests (window 0 disables it)
+BATCH_WINDOW_MS = float(os.environ.get("PROXY_BATCH_WINDOW_MS", "0"))
+BATCH_MAX_SIZE = int(os.environ.get("PROXY_BATCH_MAX_SIZE", "8"))
+BATCH_MAX_PROMPT_CHARS = int(os.environ.get("PROXY_BATCH_MAX_PROMPT_CHARS", "2000"))
+BATCH_KEEP_ALIVE = os.environ.get("PROXY_BATCH_KEEP_ALIVE", "10m")
+
+# POST /generate/batch: items in flight per request and items accepted per request
+BATCH_CONCURRENCY = int(os.environ.get("PROXY_BATCH_CONCURRENCY", "8"))
+BATCH_MAX_ITEMS = int(os.environ.get("PROXY_BATCH_MAX_ITEMS", "10000"))
+
+# Directory holding the proxy's on-disk state unless a feature's own path is set
+DATA_DIR = os.environ.get("PROXY_DATA_DIR", "proxy_data")
+
+# Asynchronous jobs (POST /jobs), persisted in SQLite and run by a worker pool
+JOBS_DB = os.environ.get("PROXY_JOBS_DB", os.path.join(DATA_DIR, "jobs.db"))
+JOB_WORKERS = int(os.environ.get("PROXY_JOB_WORKERS", "2"))
+JOB_RETENTION = float(os.environ.get("PROXY_JOB_RETENTION", "86400"))  # seconds finished jobs are kept
+JOB_LEASE = float(os.environ.get("PROXY_JOB_LEASE", "60"))  # seconds before a silent owner's job is requeued
+
+# Server-side conversation sessions (pinned backend, stored history / context tokens)
+SESSION_MAX = int(os.environ.get("PROXY_SESSION_MAX", "1000"))
+SESSION_TTL = float(os.environ.get("PROXY_SESSION_TTL", "3600"))  # seconds of inactivity
+SESSION_DB = os.environ.get("PROXY_SESSION_DB", os.path.join(DATA_DIR, "sessions.db"))  # empty: memory only
+SESSION_TOKEN_BUDGET = int(os.environ.get("PROXY_SESSION_TOKEN_BUDGET", "4096"))  # 0 = unbounded history
+SESSION_SUMMARIZE = os.environ.get("PROXY_SESSION_SUMMARIZE", "0").lower() in ("1", "true", "yes")
+SESSION_LOCK_TIMEOUT = float(os.environ.get("PROXY_SESSION_LOCK_TIMEOUT", "300"))  # seconds to wait for a busy session
+
+# POST /embed: inputs per upstream call, inputs accepted per request, and the vector cache
+# (float32 memory-mapped files plus a SQLite index; needs numpy, empty directory disables it)
+EMBED_BATCH_SIZE = int(os.environ.get("PROXY_EMBED_BATCH_SIZE", "64"))
+EMBED_MAX_INPUTS = int(os.environ.get("PROXY_EMBED_MAX_INPUTS", "4096"))
+EMBED_CACHE_DIR = os.environ.get("PROXY_EMBED_CACHE_DIR", os.path.join(DATA_DIR, "vectors"))
+EMBED_CACHE_MAX_VECTORS = int(os.environ.get("PROXY_EMBED_CACHE_MAX_VECTORS", "200000"))  # per model, oldest overwritten
+
+# Retrieval (POST /rag/index, /rag/query): chunk vectors in memory-mapped float32 files, chunk text in SQLite
+RAG_DIR = os.environ.get("PROXY_RAG_DIR", os.path.join(DATA_DIR, "rag"))  # empty disables retrieval; needs numpy
+RAG_CHUNK_CHARS = int(os.environ.get("PROXY_RAG_CHUNK_CHARS", "1000"))
+RAG_CHUNK_OVERLAP = int(os.environ.get("PROXY_RAG_CHUNK_OVERLAP", "200"))
+RAG_SEARCH_BLOCK = int(os.environ.get("PROXY_RAG_SEARCH_BLOCK", "65536"))  # rows scored per matrix product
+
+# Return non-streamed upstream bodies byte-for-byte instead of decoding and re-encoding them
+JSON_PASSTHROUGH = os.environ.get("PROXY_JSON_PASSTHROUGH", "1").lower() in ("1", "true", "yes")
+
+# Items a stream's producer may run ahead of its slowest client before it pauses reading
+STREAM_BUFFER_ITEMS = int(os.environ.get("PROXY_STREAM_BUFFER", "256"))
+
+# Upstream connection pool (shared by every handler)
+POOL_MAX_CONNECTIONS = int(os.environ.get("PROXY_POOL_MAX_CONNECTIONS", "100"))
+POOL_MAX_KEEPALIVE = int(os.environ.get("PROXY_POOL_MAX_KEEPALIVE", "20"))
+POOL_KEEPALIVE_EXPIRY = float(os.environ.get("PROXY_POOL_KEEPALIVE_EXPIRY", "30"))
+POOL_HTTP2 = os.environ.get("PROXY_POOL_HTTP2", "0").lower() in ("1", "true", "yes")
+
+class UpstreamPool:
+    """Application-lifetime httpx client with pool saturation tracking"""
+
+    def __init__(self):
+        self.client: Optional[httpx.AsyncClient] = None
+        self.http2 = False
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.total_requests = 0
+        self.saturated_requests = 0
+
+    async def start(self):
+        """Create the shared client; called once at startup"""
+        self.http2 = POOL_HTTP2
+        if self.http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                print("⚠️  PROXY_POOL_HTTP2 set but 'h2' is not installed, falling back to HTTP/1.1")
+                self.http2 = False
+        limits = httpx.Limits(
+            max_connections=POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=POOL_MAX_KEEPALIVE,
+            keepalive_expiry=POOL_KEEPALIVE_EXPIRY,
+        )
+        self.client = httpx.AsyncClient(timeout=REQUEST_TIMEOUT, limits=limits, http2=self.http2)
+
+    async def close(self):
+        """Close the shared client and its keep-alive connections; called at shutdown"""
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def _enter(self):
+        self.total_requests += 1
+        if self.in_flight >= POOL_MAX_CONNECTIONS:
+            self.saturated_requests += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def _exit(self):
+        self.in_flight -= 1
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        """GET through the shared pool"""
+        self._enter()
+        try:
+            return await self.client.get(url, **kwargs)
+        finally:
+            self._exit()
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        """POST through the shared pool"""
+        self._enter()
+        try:
+            return await self.client.post(url, **kwargs)
+        finally:
+            self._exit()
+
+    @asynccontextmanager
+    async def stream(self, method: str, url: str, **kwargs) -> AsyncIterator[httpx.Response]:
+        """Streamed request through the shared pool; the slot is held until the body is consumed"""
+        self._enter()
+        try:
+            async with self.client.stream(method, url, **kwargs) as response:
+                yield response
+        finally:
+            self._exit()
+
+    def stats(self) -> Dict[str, Any]:
+        """Pool configuration and saturation metrics"""
+        connections = []
+        pool = getattr(getattr(self.client, "_transport", None), "_pool", None)
+        if pool is not None:
+            connections = list(getattr(pool, "connections", []))
+        idle = sum(1 for conn in connections if conn.is_idle())
+        return {
+            "max_connections": POOL_MAX_CONNECTIONS,
+            "max_keepalive_connections": POOL_MAX_KEEPALIVE,
+            "keepalive_expiry": POOL_KEEPALIVE_EXPIRY,
+            "http2": self.http2,
+            "open_connections": len(connections),
+            "idle_connections": idle,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "utilization": round(self.in_flight / POOL_MAX_CONNECTIONS, 3),
+            "total_requests": self.total_requests,
+            "saturated_requests": self.saturated_requests,
+        }
+
+upstream = UpstreamPool()
+
+def model_tag(name: str) -> str:
+    """Ollama's canonical model name ("llama3" -> "llama3:latest")"""
+    return name if ":" in name else f"{name}:latest"
+
+class Backend:
+    """One Ollama host with passive health and model tracking"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.healthy = True
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.total_requests = 0
+        self.total_failures = 0
+        self.models: set = set()
+        self.last_probe: Optional[float] = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "consecutive_failures": self.consecutive_failures,
+            "total_requests": self.total_requests,
+            "total_failures": self.total_failures,
+            "models": sorted(self.models),
+            "last_probe": self.last_probe,
+        }
+
+class LoadBalancer:
+    """Spread requests over Ollama backends with passive health checks and model-aware routing"""
+
+    def __init__(self, urls: List[str], strategy: str = "least_outstanding"):
+        self.backends = [Backend(url) for url in urls]
+        self.strategy = strategy
+        self.upstream_errors: Dict[tuple, int] = {}  # (backend url, status) -> count
+        self._probe_task: Optional[asyncio.Task] = None
+
+    def candidates(self, model: Optional[str] = None) -> List[Backend]:
+        """Healthy backends, narrowed to those known to serve `model` when any do"""
+        healthy = [b for b in self.backends if b.healthy]
+        if model:
+            tag = model_tag(model)
+            serving = [b for b in healthy if tag in b.models]
+            if serving:
+                return serving
+        return healthy
+
+    def select(self, model: Optional[str] = None) -> Backend:
+        """Pick a backend for `model` using the configured strategy"""
+        candidates = self.candidates(model)
+        if not candidates:
+            raise HTTPException(status_code=503, detail="No healthy Ollama backends available")
+        if self.strategy == "p2c" and len(candidates) > 2:
+            candidates = random.sample(candidates, 2)
+        return min(candidates, key=lambda b: b.outstanding)
+
+    @asynccontextmanager
+    async def acquire(self, model: Optional[str] = None, preferred: Optional[Backend] = None) -> AsyncIterator[Backend]:
+        """Reserve a backend for one upstream call and record the outcome.
+
+        `preferred` pins the call to a backend (e.g. one a batch is already warm on) while it stays healthy.
+        """
+        backend = preferred if preferred is not None and preferred.healthy else self.select(model)
+        backend.outstanding += 1
+        backend.total_requests += 1
+        try:
+            yield backend
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            status = str(e.response.status_code) if isinstance(e, httpx.HTTPStatusError) else "transport"
+            key = (backend.url, status)
+            self.upstream_errors[key] = self.upstream_errors.get(key, 0) + 1
+            if not isinstance(e, httpx.HTTPStatusError) or e.response.status_code >= 500:
+                self.record_failure(backend)
+            raise
+        else:
+            backend.consecutive_failures = 0
+        finally:
+            backend.outstanding -= 1
+
+    def record_failure(self, backend: Backend):
+        backend.consecutive_failures += 1
+        backend.total_failures += 1
+        if backend.healthy and backend.consecutive_failures >= LB_FAILURE_THRESHOLD:
+            backend.healthy = False
+            print(f"⚠️  Ejecting backend {backend.url} after {backend.consecutive_failures} consecutive failures")
+
+    async def probe(self, backend: Backend) -> bool:
+        """Refresh a backend's model list; a failed probe ejects it, a successful one re-admits it"""
+        backend.last_probe = time.time()
+        try:
+            response = await upstream.get(f"{backend.url}/api/tags", timeout=5)
+            response.raise_for_status()
+            backend.models = {model_tag(m["name"]) for m in response.json().get("models", [])}
+        except Exception as e:
+            if backend.healthy:
+                print(f"⚠️  Ejecting backend {backend.url}: probe failed ({e})")
+            backend.healthy = False
+            return False
+        if not backend.healthy:
+            print(f"✅ Re-admitting backend {backend.url}")
+        backend.healthy = True
+        backend.consecutive_failures = 0
+        return True
+
+    async def probe_all(self):
+        await asyncio.gather(*(self.probe(b) for b in self.backends))
+
+    async def _probe_loop(self):
+        while True:
+            await asyncio.sleep(LB_PROBE_INTERVAL)
+            await self.probe_all()
+
+    async def start(self):
+        await self.probe_all()
+        self._probe_task = asyncio.create_task(self._probe_loop())
+
+    async def stop(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            self._probe_task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {"strategy": self.strategy, "backends": [b.stats() for b in self.backends]}
+
+balancer = LoadBalancer(OLLAMA_BACKENDS, LB_STRATEGY)
+
+class ModelResidency:
+    """Track which models each backend holds in memory and steer Ollama's keep_alive.
+
+    Pinned models are loaded at startup and kept resident indefinitely.
+    Other models get the default keep_alive; with a memory budget, the least
+    recently used unpinned models are unloaded to make room for a new one.
+    """
+
+    def __init__(self, pinned: List[str], keep_alive: str, memory_budget: int, poll_interval: float,
+                 cold_threshold: float):
+        self.pinned = {model_tag(m) for m in pinned}
+        self.keep_alive = keep_alive
+        self.memory_budget = memory_budget
+        self.poll_interval = poll_interval
+        self.cold_threshold = cold_threshold
+        self.resident: Dict[str, Dict[str, int]] = {}  # backend url -> model -> bytes
+        self.sizes: Dict[str, int] = {}  # last seen size per model
+        self.last_used: Dict[tuple, float] = {}  # (backend url, model) -> time
+        self.latency: Dict[tuple, LatencyHistogram] = {}  # (model, "cold" | "warm") -> time to first token
+        self.load_time: Dict[str, float] = {}
+        self.warmups = 0
+        self.warmup_failures = 0
+        self.evictions = 0
+        self._task: Optional[asyncio.Task] = None
+        self._background: set = set()
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        for task in [self._task, *self._background]:
+            if task is not None:
+                task.cancel()
+        self._task = None
+
+    async def _run(self):
+        await self.warm_up()
+        while True:
+            await self.refresh_all()
+            await asyncio.sleep(self.poll_interval)
+
+    async def warm_up(self):
+        """Load every pinned model on each healthy backend that has it"""
+        loads = [(backend, model) for model in self.pinned for backend in balancer.candidates(model)]
+        await asyncio.gather(*(self._load(backend, model) for backend, model in loads))
+
+    async def _load(self, backend: Backend, model: str):
+        try:
+            # A generate call without a prompt only loads the model
+            response = await upstream.post(f"{backend.url}/api/generate", json={"model": model, "keep_alive": -1})
+            response.raise_for_status()
+            self.warmups += 1
+        except Exception as e:
+            self.warmup_failures += 1
+            print(f"⚠️  Could not pre-load {model} on {backend.url}: {e}")
+
+    async def refresh(self, backend: Backend):
+        try:
+            response = await upstream.get(f"{backend.url}/api/ps", timeout=5)
+            response.raise_for_status()
+        except Exception:
+            return
+        loaded = {m["name"]: m.get("size", 0) for m in response.json().get("models", [])}
+        self.resident[backend.url] = loaded
+        self.sizes.update(loaded)
+
+    async def refresh_all(self):
+        await asyncio.gather(*(self.refresh(b) for b in balancer.backends if b.healthy))
+
+    def apply(self, model: str, payload: Dict[str, Any]):
+        """Default a forwarded request's keep_alive from the residency policy"""
+        if model_tag(model) in self.pinned:
+            payload.setdefault("keep_alive", -1)
+        elif self.keep_alive:
+            payload.setdefault("keep_alive", self.keep_alive)
+
+    def use(self, backend: Backend, model: str):
+        """Note that `model` is about to run on `backend`, unloading LRU models first if over budget"""
+        model = model_tag(model)
+        self.last_used[(backend.url, model)] = time.time()
+        resident = self.resident.setdefault(backend.url, {})
+        if model in resident:
+            return
+        resident[model] = self.sizes.get(model, 0)
+        if self.memory_budget:
+            task = asyncio.create_task(self._make_room(backend, model))
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+
+    async def _make_room(self, backend: Backend, model: str):
+        await self.refresh(backend)
+        resident = self.resident.get(backend.url, {})
+        needed = 0 if model in resident else self.sizes.get(model, 0)
+        victims = sorted((m for m in resident if m != model and m not in self.pinned),
+                         key=lambda m: self.last_used.get((backend.url, m), 0))
+        for victim in victims:
+            if sum(resident.values()) + needed <= self.memory_budget:
+                break
+            try:
+                response = await upstream.post(f"{backend.url}/api/generate", json={"model": victim, "keep_alive": 0})
+                response.raise_for_status()
+            except Exception:
+                continue
+            resident.pop(victim, None)
+            self.evictions += 1
+
+    def observe(self, model: str, result: Optional[Dict[str, Any]], ttft: Optional[float]):
+        """Classify a finished call as a cold or warm start from Ollama's load_duration"""
+        if not result or "load_duration" not in result or ttft is None:
+            return
+        load = result["load_duration"] / 1e9
+        state = "cold" if load >= self.cold_threshold else "warm"
+        histogram = self.latency.get((model, state))
+        if histogram is None:
+            histogram = self.latency[(model, state)] = LatencyHistogram()
+        histogram.record(ttft)
+        if state == "cold":
+            self.load_time[model] = self.load_time.get(model, 0.0) + load
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.time()
+        models: Dict[str, Any] = {}
+        for (model, state), histogram in sorted(self.latency.items()):
+            entry = models.setdefault(model, {})
+            entry[f"{state}_starts"] = histogram.count
+            entry[f"{state}_avg_ttft"] = round(histogram.total / histogram.count, 3)
+            summary = histogram.summary(3600, now)
+            if summary is not None:
+                entry[f"{state}_ttft_1h"] = summary
+            if state == "cold":
+                entry["total_load_time"] = round(self.load_time.get(model, 0.0), 3)
+        return {
+            "pinned": sorted(self.pinned),
+            "keep_alive": self.keep_alive or None,
+            "memory_budget": self.memory_budget or None,
+            "resident": {url: sorted(loaded) for url, loaded in self.resident.items()},
+            "warmups": self.warmups,
+            "warmup_failures": self.warmup_failures,
+            "evictions": self.evictions,
+            "models": models,
+        }
+
+residency = ModelResidency(PINNED_MODELS, MODEL_KEEP_ALIVE, MODEL_MEMORY_BUDGET, RESIDENCY_POLL_INTERVAL,
+                           COLD_LOAD_THRESHOLD)
+
+class TokenCounter:
+    """Prompt token counts per model.
+
+    Approximate mode divides characters by a per-model ratio calibrated from
+    the prompt_eval_count Ollama reports. Exact mode asks the model's tokenizer
+    (/api/tokenize) once per distinct text and memoizes the count, falling back
+    to the approximation for backends that lack the endpoint.
+    """
+
+    DEFAULT_CHARS_PER_TOKEN = 4.0
+    MESSAGE_OVERHEAD = 4  # chat template tokens around each message
+
+    def __init__(self, mode: str, cache_size: int, default_num_ctx: int):
+        self.mode = mode
+        self.cache_size = cache_size
+        self.default_num_ctx = default_num_ctx
+        self.chars_per_token: Dict[str, float] = {}
+        self._exact: "OrderedDict[tuple, int]" = OrderedDict()
+        self._no_tokenizer: set = set()
+        self._model_context: Dict[str, tuple] = {}  # model -> (Modelfile num_ctx, model maximum), from /api/show
+        self.exact_hits = 0
+        self.tokenizer_calls = 0
+        self.rejected = 0
+        self.trimmed = 0
+        self._observed: Dict[str, List[float]] = {}  # model -> [prompts, real tokens, abs estimate error]
+
+    def approximate(self, model: str, text: str) -> int:
+        return math.ceil(len(text) / self.chars_per_token.get(model, self.DEFAULT_CHARS_PER_TOKEN))
+
+    async def count(self, model: str, text: str) -> int:
+        if self.mode == "exact" and model not in self._no_tokenizer:
+            key = (model, hashlib.sha1(text.encode("utf-8")).digest())
+            tokens = self._exact.get(key)
+            if tokens is not None:
+                self._exact.move_to_end(key)
+                self.exact_hits += 1
+                return tokens
+            tokens = await self._tokenize(model, text)
+            if tokens is not None:
+                self._exact[key] = tokens
+                if len(self._exact) > self.cache_size:
+                    self._exact.popitem(last=False)
+                return tokens
+        return self.approximate(model, text)
+
+    async def _tokenize(self, model: str, text: str) -> Optional[int]:
+        try:
+            backend = balancer.select(model)
+            self.tokenizer_calls += 1
+            response = await upstream.post(f"{backend.url}/api/tokenize", json={"model": model, "content": text})
+            if response.status_code == 404:
+                print(f"⚠️  {backend.url} has no /api/tokenize; approximating token counts for {model}")
+                self._no_tokenizer.add(model)
+                return None
+            response.raise_for_status()
+            return len(response.json().get("tokens", []))
+        except Exception:
+            return None
+
+    async def count_payload(self, endpoint: str, model: str, payload: Dict[str, Any]) -> int:
+        if endpoint == "chat":
+            counts = [await self.count(model, m.get("content", "")) for m in payload["messages"]]
+            return sum(counts) + self.MESSAGE_OVERHEAD * len(counts)
+        tokens = await self.count(model, payload["prompt"])
+        if payload.get("system"):
+            tokens += await self.count(model, payload["system"])
+        return tokens
+
+    async def context_length(self, model: str, payload: Dict[str, Any]) -> int:
+        """The window this request will run with, capped at the model's maximum.
+
+        That is the request's num_ctx, else the Modelfile's PARAMETER num_ctx,
+        else the configured default.
+        """
+        if model not in self._model_context:
+            found = await self._show_context(model)
+            if found is None:
+                return (payload.get("options") or {}).get("num_ctx") or self.default_num_ctx
+            self._model_context[model] = found  # failed lookups are retried on the next request
+        parameter, maximum = self._model_context[model]
+        num_ctx = (payload.get("options") or {}).get("num_ctx") or parameter or self.default_num_ctx
+        return min(num_ctx, maximum) if maximum else num_ctx
+
+    async def _show_context(self, model: str) -> Optional[tuple]:
+        """(Modelfile num_ctx, model context_length) from /api/show, either possibly None; None when unavailable"""
+        try:
+            backend = balancer.select(model)
+            response = await upstream.post(f"{backend.url}/api/show", json={"model": model}, timeout=10)
+            response.raise_for_status()
+            data = response.json()
+            info = data.get("model_info") or {}
+            maximum = next((int(v) for k, v in info.items() if k.endswith(".context_length")), None)
+            parameter = None
+            for line in (data.get("parameters") or "").splitlines():
+                name, _, value = line.strip().partition(" ")
+                if name == "num_ctx":
+                    parameter = int(value.strip())
+            return parameter, maximum
+        except Exception:
+            return None
+
+    def observe(self, model: str, chars: int, prompt_tokens: int):
+        """Calibrate the model's characters-per-token ratio from a completed request"""
+        if prompt_tokens < 8 or not 1 <= chars / prompt_tokens <= 10:
+            return  # too short to tell, or most of the prompt came from Ollama's prefix cache
+        observed = self._observed.setdefault(model, [0, 0, 0.0])
+        estimate = chars / self.chars_per_token.get(model, self.DEFAULT_CHARS_PER_TOKEN)
+        observed[0] += 1
+        observed[1] += prompt_tokens
+        observed[2] += abs(estimate - prompt_tokens) / prompt_tokens
+        ratio = chars / prompt_tokens
+        current = self.chars_per_token.get(model)
+        self.chars_per_token[model] = ratio if current is None else 0.9 * current + 0.1 * ratio
+
+    def stats(self) -> Dict[str, Any]:
+        models = {}
+        for model, (prompts, tokens, error) in sorted(self._observed.items()):
+            models[model] = {
+                "prompts": int(prompts),
+                "prompt_tokens": int(tokens),
+                "chars_per_token": round(self.chars_per_token.get(model, self.DEFAULT_CHARS_PER_TOKEN), 2),
+                "approximation_error": round(error / prompts, 3) if prompts else None,
+            }
+        return {
+            "mode": self.mode,
+            "overflow_policy": CONTEXT_OVERFLOW,
+            "default_num_ctx": self.default_num_ctx,
+            "exact_cache_entries": len(self._exact),
+            "exact_cache_hits": self.exact_hits,
+            "tokenizer_calls": self.tokenizer_calls,
+            "rejected": self.rejected,
+            "trimmed": self.trimmed,
+            "models": models,
+        }
+
+token_counter = TokenCounter(TOKEN_COUNT_MODE, TOKEN_CACHE_SIZE, DEFAULT_NUM_CTX)
+
+async def context_room(model: str, payload: Dict[str, Any]) -> tuple:
+    """(context window, tokens reserved for num_predict) for a request"""
+    limit = await token_counter.context_length(model, payload)
+    return limit, max(0, (payload.get("options") or {}).get("num_predict") or 0)
+
+async def fit_context(endpoint: str, model: str, payload: Dict[str, Any]) -> Optional[int]:
+    """Count the prompt's tokens, trimming or rejecting it when it cannot fit the context window.
+
+    Ollama would otherwise silently drop the start of the prompt on the GPU.
+    """
+    if token_counter.mode == "off":
+        return None
+    tokens = await token_counter.count_payload(endpoint, model, payload)
+    if CONTEXT_OVERFLOW == "off":
+        return tokens
+    limit, reserve = await context_room(model, payload)
+    available = limit - reserve
+    if tokens <= available:
+        return tokens
+    if CONTEXT_OVERFLOW == "trim" and available > 0:
+        if endpoint == "chat":
+            # Oldest non-system messages go first; the latest message always stays
+            messages = payload["messages"]
+            while tokens > available:
+                index = next((i for i, m in enumerate(messages[:-1]) if m.get("role") != "system"), None)
+                if index is None:
+                    break
+                removed = messages.pop(index)
+                tokens -= await token_counter.count(model, removed.get("content", "")) + TokenCounter.MESSAGE_OVERHEAD
+        else:
+            # Keep the end of the prompt, which is what the model answers; the system prompt stays whole
+            system_tokens = await token_counter.count(model, payload["system"]) if payload.get("system") else 0
+            prompt = payload["prompt"]
+            room = available - system_tokens
+            prompt_tokens = tokens - system_tokens
+            keep = len(prompt)
+            while room > 0 and prompt_tokens > room and keep > 0:
+                # Shrink a little past the proportional cut so an exact count lands inside the room
+                keep = min(keep - 1, int(keep * room / prompt_tokens * 0.98))
+                prompt_tokens = await token_counter.count(model, prompt[len(prompt) - keep:])
+            payload["prompt"] = prompt[len(prompt) - keep:]
+            tokens = system_tokens + prompt_tokens
+        if tokens <= available:
+            token_counter.trimmed += 1
+            return tokens
+    token_counter.rejected += 1
+    reserved = f" after reserving {reserve} for num_predict" if reserve else ""
+    raise HTTPException(status_code=413, detail=f"Prompt is about {tokens} tokens but {model} has room for "
+                                                f"{available} (num_ctx {limit}{reserved})")
+
+def request_hash(endpoint: str, payload: Dict[str, Any]) -> str:
+    """Canonical hash of a request body; the stream flag does not change the result"""
+    body = {k: v for k, v in payload.items() if k != "stream" and v is not None}
+    canonical = json.dumps([endpoint, body], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def is_deterministic(payload: Dict[str, Any]) -> bool:
+    """True when sampling is fixed, so the same request always yields the same output"""
+    options = payload.get("options") or {}
+    temperature = options.get("temperature", payload.get("temperature"))
+    seed = options.get("seed", payload.get("seed"))
+    return temperature == 0 or seed is not None
+
+class ResponseCache:
+    """Byte-bounded in-memory LRU with an optional SQLite tier and TTL"""
+
+    def __init__(self, max_bytes: int, ttl: float, db_path: str = ""):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.db_path = db_path
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._db: Optional[sqlite3.Connection] = None
+
+    def open(self):
+        if self.db_path:
+            self._db = connect_sqlite(self.db_path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache "
+                "(key TEXT PRIMARY KEY, expires_at REAL NOT NULL, value BLOB NOT NULL)"
+            )
+            self._db.execute("DELETE FROM response_cache WHERE expires_at < ?", (time.time(),))
+            self._db.commit()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        value = self.get_bytes(key)
+        return json_loads(value) if value is not None else None
+
+    def get_bytes(self, key: str) -> Optional[bytes]:
+        """Return the cached JSON body for `key`, promoting disk hits into memory"""
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at >= now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self._remove(key)
+            self.expirations += 1
+        if self._db is not None:
+            row = self._db.execute(
+                "SELECT expires_at, value FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and row[0] >= now:
+                self._store(key, row[0], row[1])
+                self.hits += 1
+                self.disk_hits += 1
+                return row[1]
+        self.misses += 1
+        return None
+
+    def put(self, key: str, result: Dict[str, Any]):
+        self.put_bytes(key, json.dumps(result, separators=(",", ":")).encode("utf-8"))
+
+    def put_bytes(self, key: str, value: bytes):
+        expires_at = time.time() + self.ttl
+        self._store(key, expires_at, value)
+        if self._db is not None:
+            self._db.execute(
+                "INSERT OR REPLACE INTO response_cache (key, expires_at, value) VALUES (?, ?, ?)",
+                (key, expires_at, value),
+            )
+            self._db.commit()
+
+    def _store(self, key: str, expires_at: float, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (expires_at, value)
+        self.size_bytes += len(value)
+        while self.size_bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        _, value = self._entries.pop(key)
+        self.size_bytes -= len(value)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": RESPONSE_CACHE_ENABLED,
+            "entries": len(self._entries),
+            "size_bytes": self.size_bytes,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "disk_tier": bool(self._db),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL, RESPONSE_CACHE_DB)
+
+def cache_key_for(endpoint: str, payload: Dict[str, Any]) -> Optional[str]:
+    """Cache key for a request, or None when the request must not be cached"""
+    if not RESPONSE_CACHE_ENABLED or not is_deterministic(payload):
+        return None
+    return request_hash(endpoint, payload)
+
+def stream_text(endpoint: str, chunk: Dict[str, Any]) -> str:
+    """Generated text carried by one streamed chunk"""
+    if endpoint == "chat":
+        return (chunk.get("message") or {}).get("content", "")
+    return chunk.get("response", "")
+
+def assemble_stream_result(endpoint: str, chunks: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Fold streamed chunks into the equivalent non-streamed response"""
+    text = "".join(stream_text(endpoint, chunk) for chunk in chunks)
+    result = dict(chunks[-1])
+    if endpoint == "chat":
+        result["message"] = {"role": "assistant", "content": text}
+    else:
+        result["response"] = text
+    return result
+
+def replay_stream(endpoint: str, result: Dict[str, Any]) -> AsyncIterator[str]:
+    """Replay a cached result as NDJSON lines shaped like a live upstream stream"""
+    async def lines():
+        first = {k: result[k] for k in ("model", "created_at") if k in result}
+        first["done"] = False
+        last = dict(result)
+        if endpoint == "chat":
+            first["message"] = result.get("message")
+            last["message"] = {"role": "assistant", "content": ""}
+        else:
+            first["response"] = result.get("response", "")
+            last["response"] = ""
+        yield json.dumps(first)
+        yield json.dumps(last)
+    return lines()
+
+class StreamStats:
+    """Counters for streamed generations that did not run to completion"""
+
+    def __init__(self):
+        self.client_disconnects = 0
+        self.upstream_cancelled = 0
+        self.upstream_aborted = 0
+        self.backpressure_stalls = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "buffer_items": STREAM_BUFFER_ITEMS,
+            "client_disconnects": self.client_disconnects,
+            "upstream_cancelled": self.upstream_cancelled,
+            "upstream_aborted": self.upstream_aborted,
+            "backpressure_stalls": self.backpressure_stalls,
+        }
+
+stream_stats = StreamStats()
+
+class Flight:
+    """One in-progress upstream call whose output is fanned out to every subscriber.
+
+    The producer may run at most `max_buffered` items ahead of the slowest
+    subscriber, so a slow client throttles the upstream read instead of
+    growing memory. Items every subscriber has consumed are trimmed, after
+    which the flight no longer accepts new subscribers.
+    """
+
+    def __init__(self, max_buffered: int = 0):
+        self.items: List[Any] = []
+        self.base = 0  # absolute index of items[0]
+        self.trimmed = False
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.queue_time = 0.0
+        self.task: Optional[asyncio.Task] = None
+        self.max_buffered = max_buffered or STREAM_BUFFER_ITEMS
+        self._positions: Dict[int, int] = {}
+        self._ids = itertools.count()
+        self._event = asyncio.Event()
+        self._drained: Optional[asyncio.Event] = None
+
+    def publish(self, item: Any):
+        """Append an item (a streamed line or a full result) and wake subscribers"""
+        self.items.append(item)
+        if len(self.items) >= 2 * self.max_buffered:
+            self._trim()
+        self.wake()
+
+    def finish(self, error: Optional[BaseException] = None):
+        self.error = error
+        self.done = True
+        self.wake()
+
+    def wake(self):
+        event, self._event = self._event, asyncio.Event()
+        event.set()
+
+    def _lag(self) -> int:
+        if not self._positions:
+            return 0
+        return self.base + len(self.items) - min(self._positions.values())
+
+    def _trim(self):
+        if not self._positions:
+            return
+        consumed = min(self._positions.values()) - self.base
+        if consumed > 0:
+            del self.items[:consumed]
+            self.base += consumed
+            self.trimmed = True
+
+    async def wait_writable(self):
+        """Block the producer while the slowest subscriber is too far behind"""
+        if self._lag() < self.max_buffered:
+            return
+        stream_stats.backpressure_stalls += 1
+        while self._lag() >= self.max_buffered:
+            self._drained = asyncio.Event()
+            await self._drained.wait()
+
+    def _advance(self, sid: int, index: int):
+        self._positions[sid] = index
+        if self._drained is not None and self._lag() < self.max_buffered:
+            self._drained.set()
+            self._drained = None
+
+    async def iterate(self, batch: bool = False, watch: Optional["DisconnectWatch"] = None) -> AsyncIterator[Any]:
+        """Yield every item from the start, so late joiners still see the whole sequence.
+
+        With `batch` set, yield lists of all items available at that moment instead.
+        Iteration stops quietly once `watch` reports the client has gone away.
+        """
+        sid = next(self._ids)
+        index = self.base
+        self._positions[sid] = index
+        try:
+            while watch is None or not watch.disconnected:
+                end = self.base + len(self.items)
+                if index < end:
+                    offset = index - self.base
+                    if batch:
+                        items, index = self.items[offset:], end
+                        yield items
+                    else:
+                        index += 1
+                        yield self.items[offset]
+                    self._advance(sid, index)
+                    continue
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self._event.wait()
+        finally:
+            del self._positions[sid]
+            self.subscribers -= 1
+            if self._drained is not None:
+                self._drained.set()
+                self._drained = None
+            if self.subscribers == 0 and not self.done and self.task is not None:
+                # Nobody is listening any more; stop the upstream generation
+                self.task.cancel()
+
+class DisconnectWatch:
+    """Watches the ASGI receive channel and detaches the request from its flight on disconnect"""
+
+    def __init__(self, http_request: Request, flight: Flight):
+        self.disconnected = False
+        self._flight = flight
+        self._task = asyncio.create_task(self._watch(http_request.receive))
+
+    async def _watch(self, receive):
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                break
+        if not self._flight.done:
+            self.disconnected = True
+            stream_stats.client_disconnects += 1
+            self._flight.wake()
+
+    def stop(self):
+        self._task.cancel()
+
+class SingleFlight:
+    """Coalesce concurrent identical requests into one upstream call"""
+
+    def __init__(self):
+        self._flights: Dict[str, Flight] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def subscribe(self, key: Optional[str], producer: Callable[[Flight], Awaitable[None]]) -> Flight:
+        """Join the in-flight call for `key`, or start `producer` if there is none.
+
+        A key of None opts out of coalescing and always starts a private call.
+        The caller must consume `flight.iterate()` exactly once.
+        """
+        flight = self._flights.get(key) if key else None
+        if flight is None or flight.trimmed:
+            flight = Flight()
+            flight.task = asyncio.create_task(self._run(key, flight, producer))
+            if key:
+                self._flights[key] = flight
+            self.leaders += 1
+        else:
+            self.followers += 1
+        flight.subscribers += 1
+        return flight
+
+    async def _run(self, key: Optional[str], flight: Flight, producer: Callable[[Flight], Awaitable[None]]):
+        try:
+            await producer(flight)
+        except asyncio.CancelledError:
+            stream_stats.upstream_cancelled += 1
+            flight.finish(HTTPException(status_code=499, detail="Upstream request cancelled"))
+        except Exception as e:
+            if flight.items or flight.base:
+                stream_stats.upstream_aborted += 1
+            flight.finish(e)
+        else:
+            flight.finish()
+        finally:
+            if key and self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": COALESCE_MODE,
+            "in_flight": len(self._flights),
+            "upstream_calls": self.leaders,
+            "coalesced_requests": self.followers,
+        }
+
+single_flight = SingleFlight()
+
+def coalesce_key_for(endpoint: str, payload: Dict[str, Any]) -> Optional[str]:
+    """Single-flight key for a request, or None when it must not be coalesced"""
+    if COALESCE_MODE == "off" or (COALESCE_MODE == "deterministic" and not is_deterministic(payload)):
+        return None
+    return f"{request_hash(endpoint, payload)}:{'stream' if payload.get('stream') else 'full'}"
+
+def raw_coalesce_key(key: Optional[str]) -> Optional[str]:
+    """Raw byte flights publish different items than line flights, so they never share"""
+    return f"{key}:raw" if key else None
+
+class AdmissionScheduler:
+    """Bounded global and per-model concurrency with FIFO or priority wait queues.
+
+    Each model has its own queue, so a backlog held back by one model's limit
+    never delays another model while global slots are free.
+    """
+
+    def __init__(self, global_limit: int, model_limit: int, max_depth: int, policy: str, timeout: float):
+        self.global_limit = global_limit
+        self.model_limit = model_limit
+        self.max_depth = max_depth
+        self.policy = policy
+        self.timeout = timeout
+        self.active = 0
+        self.active_by_model: Dict[str, int] = {}
+        self._waiters: Dict[str, List[list]] = {}  # model -> heap of [priority, seq, model, future]
+        self._depth = 0
+        self._seq = itertools.count()
+        self.admitted = 0
+        self.queued = 0
+        self.rejected_full = 0
+        self.rejected_timeout = 0
+        self.avg_service_time = 1.0
+
+    def _has_capacity(self, model: str) -> bool:
+        return self.active < self.global_limit and self.active_by_model.get(model, 0) < self.model_limit
+
+    def _take(self, model: str):
+        self.active += 1
+        self.active_by_model[model] = self.active_by_model.get(model, 0) + 1
+        self.admitted += 1
+
+    def _release(self, model: str):
+        self.active -= 1
+        self.active_by_model[model] -= 1
+        if not self.active_by_model[model]:
+            del self.active_by_model[model]
+        self._dispatch()
+
+    def _head(self, model: str) -> Optional[list]:
+        """The model's best-ranked live waiter, dropping ones that gave up"""
+        queue = self._waiters[model]
+        while queue and queue[0][3].done():
+            heapq.heappop(queue)
+        if not queue:
+            del self._waiters[model]
+            return None
+        return queue[0]
+
+    def _dispatch(self):
+        """Hand freed slots to the best-ranked waiters whose model has capacity"""
+        while self._waiters and self.active < self.global_limit:
+            heads = [self._head(model) for model in list(self._waiters) if self._has_capacity(model)]
+            heads = [head for head in heads if head is not None]
+            if not heads:
+                return
+            waiter = min(heads)
+            heapq.heappop(self._waiters[waiter[2]])
+            self._depth -= 1
+            self._take(waiter[2])
+            waiter[3].set_result(True)
+
+    @property
+    def queue_depth(self) -> int:
+        return self._depth
+
+    def retry_after(self) -> int:
+        """Rough seconds until a slot frees up, for the Retry-After header"""
+        backlog = self._depth + 1
+        return max(1, math.ceil(self.avg_service_time * backlog / max(1, self.global_limit)))
+
+    @asynccontextmanager
+    async def slot(self, model: str, priority: int = 0) -> AsyncIterator[float]:
+        """Hold one upstream slot for `model`; yields the time spent queued"""
+        start = time.time()
+        # Slots are handed out as soon as they free up, so spare capacity means nobody can be waiting for it
+        if self._has_capacity(model) and (model not in self._waiters or self._head(model) is None):
+            self._take(model)
+        else:
+            if self._depth >= self.max_depth:
+                self.rejected_full += 1
+                raise HTTPException(status_code=429, detail="Proxy queue is full, retry later",
+                                    headers={"Retry-After": str(self.retry_after())})
+            rank = priority if self.policy == "priority" else 0
+            waiter = [rank, next(self._seq), model, asyncio.get_running_loop().create_future()]
+            heapq.heappush(self._waiters.setdefault(model, []), waiter)
+            self._depth += 1
+            self.queued += 1
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter[3]), self.timeout)
+            except BaseException as e:
+                if waiter[3].done():
+                    # The slot was granted just as we gave up on it
+                    self._release(model)
+                else:
+                    waiter[3].cancel()  # left in its heap and skipped when it reaches the head
+                    self._depth -= 1
+                if isinstance(e, asyncio.TimeoutError):
+                    self.rejected_timeout += 1
+                    raise HTTPException(status_code=503, detail="Timed out waiting for an upstream slot",
+                                        headers={"Retry-After": str(self.retry_after())})
+                raise
+        queue_time = time.time() - start
+        held_from = time.time()
+        try:
+            yield queue_time
+        finally:
+            self.avg_service_time = 0.9 * self.avg_service_time + 0.1 * (time.time() - held_from)
+            self._release(model)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "policy": self.policy,
+            "global_limit": self.global_limit,
+            "per_model_limit": self.model_limit,
+            "active": self.active,
+            "active_by_model": dict(self.active_by_model),
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_depth,
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected_queue_full": self.rejected_full,
+            "rejected_timeout": self.rejected_timeout,
+            "avg_service_time": round(self.avg_service_time, 3),
+        }
+
+scheduler = AdmissionScheduler(ADMISSION_GLOBAL_LIMIT, ADMISSION_MODEL_LIMIT, ADMISSION_QUEUE_DEPTH,
+                               ADMISSION_QUEUE_POLICY, ADMISSION_QUEUE_TIMEOUT)
+
+class StreamTail:
+    """Keeps just the bytes of an NDJSON byte stream needed to recover its last line"""
+
+    __slots__ = ("line", "pending")
+
+    def __init__(self):
+        self.line: Optional[bytes] = None
+        self.pending: List[bytes] = []
+
+    def feed(self, chunk: bytes):
+        end = chunk.rfind(b"\n")
+        if end == -1:
+            self.pending.append(chunk)
+            return
+        # Only the newest complete line and the bytes after it are kept
+        line = (b"".join(self.pending) + chunk[:end]).rstrip(b"\n").rsplit(b"\n", 1)[-1]
+        if line:
+            self.line = line
+        rest = chunk[end + 1:]
+        self.pending = [rest] if rest else []
+
+    def last_line(self) -> Optional[bytes]:
+        return b"".join(self.pending) or self.line
+
+class Batch:
+    """Requests for one model and option set released to the upstream together"""
+
+    def __init__(self, model: str):
+        self.model = model
+        self.size = 0
+        self.pending = 0
+        self.tokens = 0
+        self.backend: Optional[Backend] = None
+        self.dispatched_at: Optional[float] = None
+        self.gate = asyncio.Event()
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+class MicroBatcher:
+    """Hold short /generate requests for a few milliseconds and dispatch them as one concurrent batch.
+
+    Ollama has no batch endpoint, so a batch is a burst of concurrent calls
+    pinned to one backend with a keep_alive hint, which lets Ollama's
+    parallel slots process them together on the already loaded model.
+    """
+
+    def __init__(self, window_ms: float, max_size: int, max_prompt_chars: int, keep_alive: str):
+        self.window = window_ms / 1000
+        self.max_size = max_size
+        self.max_prompt_chars = max_prompt_chars
+        self.keep_alive = keep_alive
+        self._open: Dict[str, Batch] = {}
+        self.batches = 0
+        self.batched_requests = 0
+        self.largest_batch = 0
+        self.total_wait = 0.0
+        self.solo_tokens_per_sec = 0.0
+        self.batch_tokens_per_sec = 0.0
+
+    def eligible(self, endpoint: str, payload: Dict[str, Any]) -> bool:
+        return (self.window > 0 and endpoint == "generate"
+                and len(payload.get("prompt") or "") <= self.max_prompt_chars)
+
+    def _group(self, payload: Dict[str, Any]) -> str:
+        options = {k: v for k, v in payload.items() if k not in ("prompt", "stream") and v is not None}
+        return json.dumps(options, sort_keys=True, separators=(",", ":"))
+
+    @asynccontextmanager
+    async def join(self, endpoint: str, model: str, payload: Dict[str, Any]) -> AsyncIterator[tuple]:
+        """Wait for this request's batch to be released; yields (batch or None, time waited)"""
+        if not self.eligible(endpoint, payload):
+            yield None, 0.0
+            return
+        payload.setdefault("keep_alive", self.keep_alive)
+        key = self._group(payload)
+        batch = self._open.get(key)
+        if batch is None:
+            batch = self._open[key] = Batch(model)
+            batch.timer = asyncio.get_running_loop().call_later(self.window, self._dispatch, key, batch)
+        batch.size += 1
+        batch.pending += 1
+        if batch.size >= self.max_size:
+            self._dispatch(key, batch)
+        joined = time.time()
+        try:
+            await batch.gate.wait()
+            waited = time.time() - joined
+            self.total_wait += waited
+            yield batch, waited
+        finally:
+            batch.pending -= 1
+            if batch.pending == 0 and batch.dispatched_at is not None:
+                self._record(batch)
+
+    def _dispatch(self, key: str, batch: Batch):
+        if batch.dispatched_at is not None:
+            return
+        batch.timer.cancel()
+        if self._open.get(key) is batch:
+            del self._open[key]
+        batch.dispatched_at = time.time()
+        try:
+            batch.backend = balancer.select(batch.model)
+        except HTTPException:
+            batch.backend = None  # each member fails through the normal path
+        self.batches += 1
+        self.batched_requests += batch.size
+        self.largest_batch = max(self.largest_batch, batch.size)
+        batch.gate.set()
+
+    def _record(self, batch: Batch):
+        """Aggregate tokens/sec of a finished batch, tracked separately for solo and grouped dispatches"""
+        elapsed = time.time() - batch.dispatched_at
+        if not batch.tokens or elapsed <= 0:
+            return
+        rate = batch.tokens / elapsed
+        if batch.size == 1:
+            self.solo_tokens_per_sec = 0.9 * self.solo_tokens_per_sec + 0.1 * rate if self.solo_tokens_per_sec else rate
+        else:
+            self.batch_tokens_per_sec = 0.9 * self.batch_tokens_per_sec + 0.1 * rate if self.batch_tokens_per_sec else rate
+
+    def stats(self) -> Dict[str, Any]:
+        gain = None
+        if self.solo_tokens_per_sec and self.batch_tokens_per_sec:
+            gain = round(self.batch_tokens_per_sec / self.solo_tokens_per_sec, 2)
+        return {
+            "enabled": self.window > 0,
+            "window_ms": self.window * 1000,
+            "max_batch_size": self.max_size,
+            "batches": self.batches,
+            "batched_requests": self.batched_requests,
+            "average_batch_size": round(self.batched_requests / self.batches, 2) if self.batches else 0,
+            "largest_batch": self.largest_batch,
+            "average_wait_ms": round(self.total_wait * 1000 / self.batched_requests, 2) if self.batched_requests else 0,
+            "solo_tokens_per_sec": round(self.solo_tokens_per_sec, 1),
+            "batch_tokens_per_sec": round(self.batch_tokens_per_sec, 1),
+            "throughput_gain": gain,
+        }
+
+batcher = MicroBatcher(BATCH_WINDOW_MS, BATCH_MAX_SIZE, BATCH_MAX_PROMPT_CHARS, BATCH_KEEP_ALIVE)
+
+class Session:
+    """One conversation and the backend holding its KV cache.
+
+    Chat sessions keep a system prompt, a running summary of compacted turns
+    and the recent messages with their token counts; generate sessions keep
+    Ollama's context tokens.
+    """
+
+    def __init__(self, session_id: str, model: Optional[str], token_budget: int = 0, summarize: bool = False,
+                 system: Optional[str] = None, api_key: Optional[str] = None):
+        self.id = session_id
+        self.model = model
+        self.api_key = api_key  # the key that created the session
+        self.token_budget = token_budget
+        self.summarize = summarize
+        self.system = system
+        self.summary: Optional[str] = None
+        self.messages: List[Dict[str, Any]] = []
+        self.tokens: List[int] = []  # per message, parallel to `messages`
+        self.context: Optional[List[int]] = None
+        self.backend: Optional[Backend] = None
+        self.lock = asyncio.Lock()  # one turn at a time in this process; SessionStore.turn also covers other workers
+        self.created_at = self.updated_at = time.time()
+        self.turns = 0
+        self.history_tokens = 0  # tokens Ollama holds for this conversation after the last turn
+        self.saved_tokens = 0
+        self.saved_time = 0.0
+        self.dropped_messages = 0
+        self.compactions = 0
+        self.last_turn: Optional[Dict[str, Any]] = None
+        self._pending: List[Dict[str, Any]] = []
+
+    STATE = ("model", "api_key", "token_budget", "summarize", "system", "summary", "messages", "tokens", "context",
+             "created_at", "updated_at", "turns", "history_tokens", "saved_tokens", "saved_time",
+             "dropped_messages", "compactions", "last_turn")
+
+    def state(self) -> Dict[str, Any]:
+        state = {name: getattr(self, name) for name in self.STATE}
+        state["backend"] = self.backend.url if self.backend else None
+        return state
+
+    @classmethod
+    def from_state(cls, session_id: str, state: Dict[str, Any]) -> "Session":
+        session = cls(session_id, state.get("model"))
+        session.restore(state)
+        return session
+
+    def restore(self, state: Dict[str, Any]):
+        """Take over a saved state in place, so coroutines holding this object see it"""
+        for name in self.STATE:
+            if name in state:
+                setattr(self, name, state[name])
+        self.backend = next((b for b in balancer.backends if b.url == state.get("backend")), None)
+
+    def prefix(self) -> List[Dict[str, Any]]:
+        messages = []
+        if self.system:
+            messages.append({"role": "system", "content": self.system})
+        if self.summary:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation: {self.summary}"})
+        return messages
+
+    def estimate(self, text: str) -> int:
+        return token_counter.approximate(self.model, text)
+
+    def prompt_tokens(self) -> int:
+        return sum(self.estimate(m["content"]) for m in self.prefix()) + sum(self.tokens)
+
+    def prepare(self, endpoint: str, payload: Dict[str, Any], room: int = 0):
+        """Expand a turn's payload with the stored conversation, sliding the window to stay within budget.
+
+        `room` is what the model's context window leaves for the prompt; the
+        budget never exceeds it.
+        """
+        self.model = self.model or payload.get("model")
+        budget = min(self.token_budget, room) if self.token_budget and room else self.token_budget or room
+        if endpoint == "chat":
+            self._pending = payload["messages"]
+            if budget:
+                incoming = sum(self.estimate(m.get("content", "")) for m in self._pending)
+                while self.messages and self.prompt_tokens() + incoming > budget:
+                    self.messages.pop(0)
+                    self.tokens.pop(0)
+                    self.dropped_messages += 1
+            payload["messages"] = self.prefix() + self.messages + self._pending
+        elif self.context is not None:
+            keep = budget - self.estimate(payload["prompt"] + (payload.get("system") or ""))
+            if budget and len(self.context) > keep:
+                # Keep the most recent tokens; Ollama re-evaluates whatever it no longer has cached
+                self.context = self.context[len(self.context) - keep:] if keep > 0 else []
+            payload.setdefault("context", self.context)
+
+    def record(self, endpoint: str, result: Dict[str, Any]) -> Dict[str, Any]:
+        """Store the turn's outcome and estimate the prompt evaluation it avoided.
+
+        Without reuse Ollama re-evaluates the whole history, so a prompt_eval_count
+        below the history length means the stored prefix was served from its cache.
+        """
+        if endpoint == "chat":
+            reply = result.get("message") or {"role": "assistant", "content": ""}
+            self.messages += self._pending + [reply]
+            self.tokens += [self.estimate(m.get("content", "")) for m in self._pending]
+            self.tokens.append(result.get("eval_count") or self.estimate(reply.get("content", "")))
+            self._pending = []
+        elif result.get("context"):
+            self.context = result["context"]
+        prompt_tokens = result.get("prompt_eval_count") or 0
+        reused = self.history_tokens if 0 < prompt_tokens < self.history_tokens else 0
+        per_token = result.get("prompt_eval_duration", 0) / 1e9 / prompt_tokens if prompt_tokens else 0.0
+        self.history_tokens = (self.history_tokens if reused else 0) + prompt_tokens + (result.get("eval_count") or 0)
+        self.turns += 1
+        self.saved_tokens += reused
+        self.saved_time += reused * per_token
+        self.updated_at = time.time()
+        self.last_turn = {
+            "prompt_eval_count": prompt_tokens,
+            "reused_tokens": reused,
+            "saved_prompt_eval_seconds": round(reused * per_token, 4),
+        }
+        return self.last_turn
+
+    def needs_compaction(self) -> bool:
+        # Compact at 3/4 of the budget, down to 1/2, so summaries are rare and the prefix stays stable between them
+        return bool(self.summarize and self.token_budget and len(self.messages) > 2
+                    and self.prompt_tokens() > self.token_budget * 3 // 4)
+
+    def summary_tokens(self) -> int:
+        """Length asked of the summarizer"""
+        return max(16, self.token_budget // 8)
+
+    def compaction_split(self) -> int:
+        """Number of leading messages to fold into the summary"""
+        fixed = self.summary_tokens() + (self.estimate(self.system) if self.system else 0)
+        keep, kept = self.token_budget // 2 - fixed, 0
+        cut = len(self.messages)
+        while cut > 0 and kept + self.tokens[cut - 1] <= keep:
+            cut -= 1
+            kept += self.tokens[cut]
+        return min(cut, len(self.messages) - 2)
+
+    def info(self, include_messages: bool = False) -> Dict[str, Any]:
+        info = {
+            "id": self.id,
+            "model": self.model,
+            "backend": self.backend.url if self.backend else None,
+            "token_budget": self.token_budget or None,
+            "summarize": self.summarize,
+            "messages": len(self.messages),
+            "prompt_tokens": self.prompt_tokens(),
+            "context_tokens": len(self.context) if self.context else 0,
+            "history_tokens": self.history_tokens,
+            "turns": self.turns,
+            "dropped_messages": self.dropped_messages,
+            "compactions": self.compactions,
+            "saved_prompt_tokens": self.saved_tokens,
+            "saved_prompt_eval_seconds": round(self.saved_time, 3),
+            "last_turn": self.last_turn,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+        if include_messages:
+            info["system"] = self.system
+            info["summary"] = self.summary
+            info["history"] = self.messages
+        return info
+
+class SessionStore:
+    """Sessions in an in-memory LRU, written through to SQLite so they outlive the LRU, restarts and workers.
+
+    Turns of one session are serialized across worker processes by a lease
+    row in the same database, written through its own connection on a
+    dedicated thread so lock waits never block the event loop.
+    """
+
+    LEASE_SECONDS = 30.0  # renewed while a turn runs; only a dead process lets one run out
+
+    def __init__(self, max_sessions: int, ttl: float, db_path: str, token_budget: int, summarize: bool,
+                 lock_timeout: float):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.db_path = db_path
+        self.token_budget = token_budget
+        self.summarize = summarize
+        self.lock_timeout = lock_timeout
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._db: Optional[sqlite3.Connection] = None
+        self._leases: Optional[sqlite3.Connection] = None
+        self._lease_writer: Optional[ThreadPoolExecutor] = None
+        self._background: set = set()
+        self.created = 0
+        self.expired = 0
+        self.evicted = 0
+        self.disk_loads = 0
+        self.turns = 0
+        self.reused_turns = 0
+        self.saved_tokens = 0
+        self.saved_time = 0.0
+        self.compactions = 0
+        self.compaction_failures = 0
+
+    def open(self):
+        if self.db_path:
+            self._db = connect_sqlite(self.db_path)
+            self._db.execute("CREATE TABLE IF NOT EXISTS sessions "
+                             "(id TEXT PRIMARY KEY, updated_at REAL NOT NULL, state TEXT NOT NULL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS session_leases "
+                             "(id TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)")
+            self._db.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - self.ttl,))
+            self._db.execute("DELETE FROM session_leases WHERE expires_at < ?", (time.time(),))
+            self._db.commit()
+            self._leases = connect_sqlite(self.db_path)
+            self._lease_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-leases")
+
+    async def close(self):
+        for task in list(self._background):
+            task.cancel()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+            await self._lease_call(self._leases.close)
+            self._lease_writer.shutdown()
+            self._leases = self._lease_writer = None
+
+    def create(self, model: Optional[str] = None, token_budget: Optional[int] = None,
+               summarize: Optional[bool] = None, system: Optional[str] = None,
+               api_key: Optional[str] = None) -> Session:
+        session = Session(uuid.uuid4().hex, model,
+                          self.token_budget if token_budget is None else token_budget,
+                          self.summarize if summarize is None else summarize, system, api_key)
+        self._remember(session)
+        self.save(session)
+        self.created += 1
+        return session
+
+    def _remember(self, session: Session):
+        self._sessions[session.id] = session
+        self._sessions.move_to_end(session.id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)  # still on disk
+            self.evicted += 1
+
+    def get(self, session_id: str) -> Optional[Session]:
+        session = self._sessions.get(session_id)
+        if self._db is not None:
+            row = self._db.execute("SELECT updated_at, state FROM sessions WHERE id = ?", (session_id,)).fetchone()
+            if row is None:
+                session = None
+                self._sessions.pop(session_id, None)
+            elif session is None:
+                session = Session.from_state(session_id, json.loads(row[1]))
+                self.disk_loads += 1
+            elif row[0] > session.updated_at:
+                # Another worker has moved the conversation on
+                session.restore(json.loads(row[1]))
+                self.disk_loads += 1
+        if session is None:
+            return None
+        if time.time() - session.updated_at > self.ttl:
+            self.delete(session_id)
+            self.expired += 1
+            return None
+        self._remember(session)
+        return session
+
+    @asynccontextmanager
+    async def turn(self, session: Session) -> AsyncIterator[None]:
+        """Hold `session` for one turn in this process and, with a database, in every other worker.
+
+        Once the lease is held the session is refreshed from disk, so the turn
+        extends the latest history whichever worker wrote it.
+        """
+        async with session.lock:
+            if self._db is None:
+                yield
+                return
+            owner = uuid.uuid4().hex
+            await self._acquire(session.id, owner)
+            renew = asyncio.create_task(self._renew(session.id, owner))
+            try:
+                row = self._db.execute("SELECT updated_at, state FROM sessions WHERE id = ?", (session.id,)).fetchone()
+                if row is not None and row[0] > session.updated_at:
+                    session.restore(json.loads(row[1]))
+                    self.disk_loads += 1
+                yield
+            finally:
+                renew.cancel()
+                # Shielded so a cancelled turn still frees the session for other workers straight away
+                await asyncio.shield(self._lease_call(self._write_lease,
+                                                      "DELETE FROM session_leases WHERE id = ? AND owner = ?",
+                                                      (session.id, owner)))
+
+    async def _lease_call(self, function: Callable, *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._lease_writer, function, *args)
+
+    def _write_lease(self, sql: str, params: tuple) -> int:
+        count = self._leases.execute(sql, params).rowcount
+        self._leases.commit()
+        return count
+
+    async def _acquire(self, session_id: str, owner: str):
+        deadline = time.time() + self.lock_timeout
+        delay = 0.05
+        while True:
+            now = time.time()
+            claimed = await self._lease_call(
+                self._write_lease,
+                "INSERT INTO session_leases (id, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE session_leases.expires_at < ?", (session_id, owner, now + self.LEASE_SECONDS, now))
+            if claimed:
+                return
+            if now > deadline:
+                raise HTTPException(status_code=409, detail="Session is busy with another request")
+            # Another worker holds the turn; back off so a long generation is not polled at 20 Hz
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+    async def _renew(self, session_id: str, owner: str):
+        while True:
+            await asyncio.sleep(self.LEASE_SECONDS / 3)
+            await self._lease_call(self._write_lease,
+                                   "UPDATE session_leases SET expires_at = ? WHERE id = ? AND owner = ?",
+                                   (time.time() + self.LEASE_SECONDS, session_id, owner))
+
+    def save(self, session: Session):
+        if self._db is not None:
+            self._db.execute("INSERT OR REPLACE INTO sessions (id, updated_at, state) VALUES (?, ?, ?)",
+                             (session.id, session.updated_at, json.dumps(session.state())))
+            self._db.commit()
+
+    def delete(self, session_id: str) -> bool:
+        found = self._sessions.pop(session_id, None) is not None
+        if self._db is not None:
+            found = self._db.execute("DELETE FROM sessions WHERE id = ?", (session_id,)).rowcount > 0 or found
+            self._db.commit()
+        return found
+
+    def record(self, session: Session, endpoint: str, result: Dict[str, Any]):
+        turn = session.record(endpoint, result)
+        self.turns += 1
+        if turn["reused_tokens"]:
+            self.reused_turns += 1
+            self.saved_tokens += turn["reused_tokens"]
+            self.saved_time += turn["saved_prompt_eval_seconds"]
+        self.save(session)
+        if session.needs_compaction():
+            task = asyncio.create_task(self.compact(session))
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+
+    async def compact(self, session: Session):
+        """Fold the oldest turns into the running summary, off the request path"""
+        async with self.turn(session):
+            cut = session.compaction_split() if session.needs_compaction() else 0
+            if cut <= 0:
+                return
+            old = session.messages[:cut]
+            transcript = "\n".join(f"{m['role']}: {m['content']}" for m in old)
+            if session.summary:
+                transcript = f"Earlier summary: {session.summary}\n{transcript}"
+            prompt = ("Summarize the following conversation in a few sentences, keeping names, facts, "
+                      f"decisions and open questions:\n\n{transcript}\n\nSummary:")
+            try:
+                async with scheduler.slot(session.model, priority=10), \
+                        balancer.acquire(session.model, session.backend) as backend:
+                    response = await upstream.post(f"{backend.url}/api/generate", json={
+                        "model": session.model, "prompt": prompt, "stream": False,
+                        "options": {"num_predict": session.summary_tokens()},
+                    })
+                    response.raise_for_status()
+                summary = json_loads(response.content).get("response", "").strip()
+            except Exception as e:
+                self.compaction_failures += 1
+                print(f"⚠️  Could not summarize session {session.id}: {e}")
+                return
+            session.summary = summary
+            del session.messages[:cut]
+            del session.tokens[:cut]
+            session.compactions += 1
+            session.updated_at = time.time()
+            self.compactions += 1
+            self.save(session)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": len(self._sessions),
+            "max_sessions": self.max_sessions,
+            "ttl": self.ttl,
+            "persistent": self._db is not None,
+            "default_token_budget": self.token_budget or None,
+            "summarize_by_default": self.summarize,
+            "created": self.created,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "disk_loads": self.disk_loads,
+            "turns": self.turns,
+            "turns_with_reuse": self.reused_turns,
+            "saved_prompt_tokens": self.saved_tokens,
+            "saved_prompt_eval_seconds": round(self.saved_time, 3),
+            "compactions": self.compactions,
+            "compaction_failures": self.compaction_failures,
+        }
+
+sessions = SessionStore(SESSION_MAX, SESSION_TTL, SESSION_DB, SESSION_TOKEN_BUDGET, SESSION_SUMMARIZE,
+                        SESSION_LOCK_TIMEOUT)
+
+@asynccontextmanager
+async def upstream_call(flight: Flight, endpoint: str, model: str, payload: Dict[str, Any],
+                        priority: int, session: Optional[Session] = None) -> AsyncIterator[tuple]:
+    """Session turn, batch window, admission slot and backend for one upstream call; yields (backend, batch)"""
+    async with sessions.turn(session) if session else contextlib.nullcontext():
+        if session:
+            # The stored history is only known here, so the context check runs on the expanded payload
+            room = 0
+            if token_counter.mode != "off" and CONTEXT_OVERFLOW != "off":
+                limit, reserve = await context_room(model, payload)
+                room = max(1, limit - reserve)
+            session.prepare(endpoint, payload, room)
+            await fit_context(endpoint, model, payload)
+        residency.apply(model, payload)
+        async with batcher.join(endpoint, model, payload) as (batch, batch_wait):
+            async with scheduler.slot(model, priority) as slot_wait:
+                flight.queue_time = batch_wait + slot_wait
+                # A session stays on the backend whose KV cache already holds its prefix
+                preferred = session.backend if session and session.backend else (batch.backend if batch else None)
+                async with balancer.acquire(model, preferred) as backend:
+                    residency.use(backend, model)
+                    if session:
+                        session.backend = backend
+                    yield backend, batch
+
+GENERATION_STATS = ("total_duration", "load_duration", "prompt_eval_count", "prompt_eval_duration",
+                    "eval_count", "eval_duration")
+
+def generation_stats(body: bytes) -> Dict[str, Any]:
+    """Ollama's token counts and timings from a response body, without decoding the generated text.
+
+    Ollama writes these fields after the text and context, so only the tail
+    from the first of them onwards is parsed.
+    """
+    positions = [p for p in (body.rfind(b'"' + field.encode() + b'"') for field in GENERATION_STATS) if p > 0]
+    data = None
+    if positions:
+        try:
+            data = json_loads(b"{" + body[min(positions):])
+        except ValueError:
+            pass
+    if not isinstance(data, dict):
+        data = json_loads(body)
+    return {field: data[field] for field in GENERATION_STATS if field in data}
+
+class RawResult:
+    """A buffered upstream response: its original bytes plus the stats fields the proxy reads"""
+
+    __slots__ = ("body", "stats")
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.stats = generation_stats(body)
+
+def json_response(result: RawResult, headers: Optional[Dict[str, str]] = None):
+    """Client response for a buffered result, relayed unchanged unless pass-through is off"""
+    if JSON_PASSTHROUGH:
+        return Response(result.body, media_type="application/json", headers=headers)
+    return JSONResponse(json.loads(result.body), headers=headers)
+
+def fetch_upstream(endpoint: str, model: str, payload: Dict[str, Any], cache_key: Optional[str],
+                   priority: int = 0, session: Optional[Session] = None) -> Callable[[Flight], Awaitable[None]]:
+    """Producer for a buffered call; publishes the raw result once"""
+    async def producer(flight: Flight):
+        async with upstream_call(flight, endpoint, model, payload, priority, session) as (backend, batch):
+            response = await upstream.post(f"{backend.url}/api/{endpoint}", json=payload)
+            response.raise_for_status()
+            result = RawResult(response.content)
+            if batch:
+                batch.tokens += result.stats.get("eval_count") or 0
+            if session:
+                sessions.record(session, endpoint, json_loads(result.body))
+        if cache_key:
+            response_cache.put_bytes(cache_key, result.body)
+        flight.publish(result)
+    return producer
+
+def stream_upstream(endpoint: str, model: str, payload: Dict[str, Any], cache_key: Optional[str],
+                    priority: int = 0, raw: bool = False,
+                    session: Optional[Session] = None) -> Callable[[Flight], Awaitable[None]]:
+    """Producer for a streamed call; publishes each NDJSON line as it arrives.
+
+    In raw mode the upstream byte chunks are published as-is, without decoding.
+    """
+    async def producer(flight: Flight):
+        chunks = []
+        async with upstream_call(flight, endpoint, model, payload, priority, session) as (backend, batch):
+            async with upstream.stream("POST", f"{backend.url}/api/{endpoint}", json=payload) as response:
+                response.raise_for_status()
+                if raw:
+                    tail = StreamTail() if batch else None
+                    async for chunk in response.aiter_bytes():
+                        if tail is not None:
+                            tail.feed(chunk)
+                        flight.publish(chunk)
+                        await flight.wait_writable()
+                    last = tail.last_line() if tail is not None else None
+                    if last:
+                        batch.tokens += json_loads(last).get("eval_count") or 0
+                    return
+                last = None
+                async for line in response.aiter_lines():
+                    if line:
+                        if cache_key or session:
+                            chunks.append(json_loads(line))
+                        last = line
+                        flight.publish(line)
+                        await flight.wait_writable()
+                if batch and last:
+                    batch.tokens += json_loads(last).get("eval_count") or 0
+                if session and chunks and chunks[-1].get("done"):
+                    sessions.record(session, endpoint, assemble_stream_result(endpoint, chunks))
+        if cache_key and chunks and chunks[-1].get("done"):
+            response_cache.put(cache_key, assemble_stream_result(endpoint, chunks))
+    return producer
+
+async def first_item(flight: Flight, watch: Optional[DisconnectWatch] = None) -> Any:
+    """Await the single result published by a buffered flight"""
+    try:
+        async for item in flight.iterate(watch=watch):
+            return item
+    finally:
+        if watch is not None:
+            watch.stop()
+    if watch is not None and watch.disconnected:
+        raise HTTPException(status_code=499, detail="Client disconnected")
+    raise RuntimeError("Upstream call finished without a result")
+
+async def open_stream(flight: Flight, batch: bool = False, watch: Optional[DisconnectWatch] = None) -> AsyncIterator[Any]:
+    """Wait for a streamed flight's first item before the response is committed.
+
+    Queue rejections and upstream errors then surface as proper HTTP errors
+    instead of a truncated 200 stream.
+    """
+    items = flight.iterate(batch, watch)
+    try:
+        first = await items.__anext__()
+    except StopAsyncIteration:
+        first = None
+    except BaseException:
+        if watch is not None:
+            watch.stop()
+        raise
+
+    async def rest():
+        if first is not None:
+            yield first
+        async for item in items:
+            yield item
+    return rest()
+
+def request_priority(http_request: Request) -> int:
+    """Queue priority from the X-Priority header (lower runs sooner)"""
+    try:
+        return int(http_request.headers.get("x-priority", "0"))
+    except ValueError:
+        return 0
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+
+class RateLimitStore(ABC):
+    """Token-bucket storage interface; implementations may share state across workers"""
+
+    @abstractmethod
+    async def take(self, key: str, rate: float, burst: float, cost: float) -> float:
+        """Remove `cost` tokens if available; returns 0 when allowed, else seconds to wait"""
+
+    @abstractmethod
+    async def debit(self, key: str, rate: float, burst: float, cost: float):
+        """Remove `cost` tokens unconditionally (the bucket may go into debt)"""
+
+    async def close(self):
+        pass
+
+    def size(self) -> Optional[int]:
+        return None
+
+class MemoryRateLimitStore(RateLimitStore):
+    """In-process buckets, O(1) per request; idle full buckets are purged when the table grows"""
+
+    def __init__(self, max_buckets: int = 100_000):
+        self.max_buckets = max_buckets
+        self._buckets: Dict[str, TokenBucket] = {}
+
+    def _refill(self, key: str, rate: float, burst: float) -> TokenBucket:
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_buckets:
+                self._purge(now)
+            bucket = self._buckets[key] = TokenBucket(burst, now)
+        else:
+            bucket.tokens = min(burst, bucket.tokens + (now - bucket.updated) * rate)
+            bucket.updated = now
+        return bucket
+
+    def _purge(self, now: float):
+        # Buckets untouched for a minute have almost always refilled completely
+        stale = [k for k, b in self._buckets.items() if now - b.updated > 60]
+        for key in stale:
+            del self._buckets[key]
+
+    async def take(self, key: str, rate: float, burst: float, cost: float) -> float:
+        bucket = self._refill(key, rate, burst)
+        if bucket.tokens < cost:
+            return (cost - bucket.tokens) / rate
+        bucket.tokens -= cost
+        return 0.0
+
+    async def debit(self, key: str, rate: float, burst: float, cost: float):
+        self._refill(key, rate, burst).tokens -= cost
+
+    def size(self) -> Optional[int]:
+        return len(self._buckets)
+
+class RedisRateLimitStore(RateLimitStore):
+    """Buckets in a Redis-compatible server, so every worker enforces the same limits"""
+
+    SCRIPT = """
+    local rate, burst, cost, now, take = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4]), ARGV[5] == '1'
+    local state = redis.call('HMGET', KEYS[1], 't', 'u')
+    local tokens = tonumber(state[1]) or burst
+    local updated = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + (now - updated) * rate)
+    local wait = 0
+    if take and tokens < cost then
+        wait = (cost - tokens) / rate
+    else
+        tokens = tokens - cost
+    end
+    redis.call('HSET', KEYS[1], 't', tokens, 'u', now)
+    redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 2000) + 1000)
+    return tostring(wait)
+    """
+
+    def __init__(self, url: str):
+        try:
+            import redis.asyncio as redis_asyncio
+        except ImportError:
+            raise RuntimeError("PROXY_RATE_LIMIT_BACKEND points at Redis but the 'redis' package is not installed")
+        self._redis = redis_asyncio.from_url(url)
+        self._script = self._redis.register_script(self.SCRIPT)
+
+    async def _call(self, key: str, rate: float, burst: float, cost: float, take: bool) -> float:
+        wait = await self._script(keys=[f"ollama-proxy:rl:{key}"],
+                                  args=[rate, burst, cost, time.time(), "1" if take else "0"])
+        return float(wait)
+
+    async def take(self, key: str, rate: float, burst: float, cost: float) -> float:
+        return await self._call(key, rate, burst, cost, True)
+
+    async def debit(self, key: str, rate: float, burst: float, cost: float):
+        await self._call(key, rate, burst, cost, False)
+
+    async def close(self):
+        await self._redis.close()
+
+class SQLiteRateLimitStore(RateLimitStore):
+    """Buckets in a local SQLite file shared by every worker process on the host.
+
+    Updates run one at a time on a dedicated writer thread, so a write
+    transaction waiting on another worker's lock never stalls the event loop.
+    """
+
+    def __init__(self, path: str):
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rate-limit-db")
+        self._db = connect_sqlite(path)
+        self._db.isolation_level = None  # explicit transactions below
+        self._db.execute("CREATE TABLE IF NOT EXISTS rate_limits "
+                         "(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+        self._db.execute("DELETE FROM rate_limits WHERE updated < ?", (time.time() - 3600,))
+
+    def _update(self, key: str, rate: float, burst: float, cost: float, take: bool) -> float:
+        now = time.time()
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._db.execute("SELECT tokens, updated FROM rate_limits WHERE key = ?", (key,)).fetchone()
+            tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+            wait = 0.0
+            if take and tokens < cost:
+                wait = (cost - tokens) / rate
+            else:
+                tokens -= cost
+            self._db.execute("INSERT OR REPLACE INTO rate_limits (key, tokens, updated) VALUES (?, ?, ?)",
+                             (key, tokens, now))
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        return wait
+
+    async def _call(self, key: str, rate: float, burst: float, cost: float, take: bool) -> float:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, self._update, key, rate, burst, cost, take)
+
+    async def take(self, key: str, rate: float, burst: float, cost: float) -> float:
+        return await self._call(key, rate, burst, cost, True)
+
+    async def debit(self, key: str, rate: float, burst: float, cost: float):
+        await self._call(key, rate, burst, cost, False)
+
+    async def close(self):
+        await asyncio.get_running_loop().run_in_executor(self._writer, self._db.close)
+        self._writer.shutdown()
+
+    def size(self) -> Optional[int]:
+        return self._db.execute("SELECT COUNT(*) FROM rate_limits").fetchone()[0]
+
+def create_rate_limit_store(spec: str) -> RateLimitStore:
+    if spec.startswith(("redis://", "rediss://", "unix://")):
+        return RedisRateLimitStore(spec)
+    if spec.startswith("sqlite:///"):
+        return SQLiteRateLimitStore(spec[len("sqlite:///"):])
+    if SHARED_STATE_DB:
+        # Workers must agree on limits, so per-process buckets are not enough
+        return SQLiteRateLimitStore(SHARED_STATE_DB)
+    return MemoryRateLimitStore()
+
+class RateLimiter:
+    """Per-IP and per-API-key request limits plus a per-key generated-token quota"""
+
+    def __init__(self):
+        self.store: RateLimitStore = MemoryRateLimitStore()
+        self.allowed = 0
+        self.limited_ip = 0
+        self.limited_key = 0
+        self.limited_tokens = 0
+        self.delayed = 0
+        self.tokens_charged = 0
+
+    def _reject(self, detail: str, wait: float):
+        raise HTTPException(status_code=429, detail=detail, headers={"Retry-After": str(max(1, math.ceil(wait)))})
+
+    async def check(self, client_ip: str, api_key: Optional[str]):
+        wait = await self.store.take(f"ip:{client_ip}", RATE_LIMIT_IP_RATE, RATE_LIMIT_IP_BURST, 1)
+        if wait:
+            self.limited_ip += 1
+            self._reject("Rate limit exceeded for this client", wait)
+        if api_key:
+            wait = await self.store.take(f"key:{api_key}", RATE_LIMIT_KEY_RATE, RATE_LIMIT_KEY_BURST, 1)
+            if wait:
+                self.limited_key += 1
+                self._reject("Rate limit exceeded for this API key", wait)
+            await self._check_quota(api_key)
+        self.allowed += 1
+
+    async def pace(self, client_ip: str, api_key: Optional[str]):
+        """Like check, but waits for the request buckets to refill instead of rejecting.
+
+        For batch items, which are queued work rather than bursts of calls; only
+        an exhausted token quota is still an error.
+        """
+        buckets = [(f"ip:{client_ip}", RATE_LIMIT_IP_RATE, RATE_LIMIT_IP_BURST)]
+        if api_key:
+            buckets.append((f"key:{api_key}", RATE_LIMIT_KEY_RATE, RATE_LIMIT_KEY_BURST))
+        delayed = False
+        for key, rate, burst in buckets:
+            wait = await self.store.take(key, rate, burst, 1)
+            while wait:
+                delayed = True
+                await asyncio.sleep(wait)
+                wait = await self.store.take(key, rate, burst, 1)
+        self.delayed += delayed
+        if api_key:
+            await self._check_quota(api_key)
+        self.allowed += 1
+
+    async def _check_quota(self, api_key: str):
+        if TOKEN_QUOTA_PER_MINUTE:
+            # A key may overdraw on its last request; it is blocked until the debt refills
+            wait = await self.store.take(f"tokens:{api_key}", TOKEN_QUOTA_PER_MINUTE / 60, TOKEN_QUOTA_PER_MINUTE, 0)
+            if wait:
+                self.limited_tokens += 1
+                self._reject("Token quota exhausted for this API key", wait)
+
+    async def charge_tokens(self, api_key: Optional[str], result: Optional[Dict[str, Any]]):
+        """Charge a key's quota with the generated token count Ollama reported"""
+        tokens = (result or {}).get("eval_count") or 0
+        if not tokens or not api_key:
+            return
+        self.tokens_charged += tokens
+        if TOKEN_QUOTA_PER_MINUTE:
+            await self.store.debit(f"tokens:{api_key}", TOKEN_QUOTA_PER_MINUTE / 60, TOKEN_QUOTA_PER_MINUTE, tokens)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": RATE_LIMIT_ENABLED,
+            "backend": type(self.store).__name__,
+            "buckets": self.store.size(),
+            "auth_required": bool(API_KEYS),
+            "allowed": self.allowed,
+            "limited_ip": self.limited_ip,
+            "limited_key": self.limited_key,
+            "limited_tokens": self.limited_tokens,
+            "delayed": self.delayed,
+            "tokens_charged": self.tokens_charged,
+        }
+
+rate_limiter = RateLimiter()
+
+def request_api_key(http_request: Request) -> Optional[str]:
+    """API key from `Authorization: Bearer <key>` or `X-API-Key`"""
+    auth = http_request.headers.get("authorization", "")
+    if auth.lower().startswith("bearer "):
+        return auth[7:].strip() or None
+    return http_request.headers.get("x-api-key") or None
+
+def client_ip(http_request: Request) -> str:
+    return http_request.client.host if http_request.client else "unknown"
+
+async def authenticate(http_request: Request) -> Optional[str]:
+    """Dependency enforcing authentication only, for routes that rate-limit per unit of work; returns the API key"""
+    api_key = request_api_key(http_request)
+    if API_KEYS and api_key not in API_KEYS:
+        raise HTTPException(status_code=401, detail="Missing or invalid API key",
+                            headers={"WWW-Authenticate": "Bearer"})
+    return api_key
+
+async def rate_limit(http_request: Request) -> Optional[str]:
+    """Dependency enforcing authentication and rate limits; returns the caller's API key"""
+    api_key = await authenticate(http_request)
+    if RATE_LIMIT_ENABLED:
+        await rate_limiter.check(client_ip(http_request), api_key)
+    return api_key
+
+class LiveJob:
+    """Output of a running job, kept in memory so clients can attach to it"""
+
+    def __init__(self):
+        self.lines: List[str] = []
+        self.done = False
+        self.changed = asyncio.Condition()
+
+    async def append(self, line: str):
+        async with self.changed:
+            self.lines.append(line)
+            self.changed.notify_all()
+
+    async def finish(self):
+        async with self.changed:
+            self.done = True
+            self.changed.notify_all()
+
+class JobQueue:
+    """Generate/chat jobs persisted in SQLite and executed by a fixed pool of workers.
+
+    A running job holds a lease that its process renews; jobs whose lease
+    runs out (the process died) and jobs still queued when the proxy stopped
+    are picked up again, by this process or any other sharing the database.
+    """
+
+    def __init__(self, db_path: str, workers: int, retention: float, lease: float):
+        self.db_path = db_path
+        self.workers = workers
+        self.retention = retention
+        self.lease = lease
+        self.owner = uuid.uuid4().hex
+        self._db: Optional[sqlite3.Connection] = None
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._enqueued: set = set()
+        self._tasks: List[asyncio.Task] = []
+        self.live: Dict[str, LiveJob] = {}
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.recovered = 0
+        self.expired_leases = 0
+
+    def open(self):
+        self._db = connect_sqlite(self.db_path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, endpoint TEXT NOT NULL, payload TEXT NOT NULL, "
+            "api_key TEXT, priority INTEGER NOT NULL, status TEXT NOT NULL, created_at REAL NOT NULL, "
+            "started_at REAL, finished_at REAL, result TEXT, error TEXT, owner TEXT, lease_until REAL)"
+        )
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(jobs)")}
+        for column, kind in (("owner", "TEXT"), ("lease_until", "REAL")):
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+        self._db.execute("DELETE FROM jobs WHERE finished_at < ?", (time.time() - self.retention,))
+        self._db.commit()
+        self.recovered = self._requeue_expired() + self._enqueue_queued()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._maintain()))
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._db is not None:
+            # Hand this process's interrupted jobs back at once instead of waiting for their leases to run out
+            self._db.execute("UPDATE jobs SET status = 'queued', started_at = NULL, owner = NULL, lease_until = NULL "
+                             "WHERE status = 'running' AND owner = ?", (self.owner,))
+            self._db.commit()
+            self._db.close()
+            self._db = None
+
+    def _enqueue(self, job_id: str):
+        if job_id not in self._enqueued:
+            self._enqueued.add(job_id)
+            self._queue.put_nowait(job_id)
+
+    def _enqueue_queued(self) -> int:
+        """Queue every job waiting in the database, including ones another process accepted and then lost"""
+        rows = self._db.execute("SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at")
+        job_ids = [job_id for job_id, in rows]
+        new = [job_id for job_id in job_ids if job_id not in self._enqueued]
+        for job_id in new:
+            self._enqueue(job_id)
+        return len(new)
+
+    def _requeue_expired(self) -> int:
+        """Put running jobs whose owner stopped renewing their lease back in the queue"""
+        count = self._db.execute(
+            "UPDATE jobs SET status = 'queued', started_at = NULL, owner = NULL, lease_until = NULL "
+            "WHERE status = 'running' AND COALESCE(lease_until, 0) < ?", (time.time(),)
+        ).rowcount
+        self._db.commit()
+        return count
+
+    async def _maintain(self):
+        """Renew this process's leases and pick up jobs abandoned by processes that died"""
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            self._db.execute("UPDATE jobs SET lease_until = ? WHERE status = 'running' AND owner = ?",
+                             (time.time() + self.lease, self.owner))
+            self._db.commit()
+            expired = self._requeue_expired()
+            if expired:
+                self.expired_leases += expired
+                print(f"⚠️  Requeued {expired} job(s) whose worker stopped renewing its lease")
+            self._enqueue_queued()
+
+    def submit(self, endpoint: str, payload: Dict[str, Any], api_key: Optional[str], priority: int) -> str:
+        job_id = uuid.uuid4().hex
+        self._db.execute(
+            "INSERT INTO jobs (id, endpoint, payload, api_key, priority, status, created_at) "
+            "VALUES (?, ?, ?, ?, ?, 'queued', ?)",
+            (job_id, endpoint, json.dumps(payload), api_key, priority, time.time()),
+        )
+        self._db.commit()
+        self._enqueue(job_id)
+        self.submitted += 1
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = self._db.execute(
+            "SELECT id, endpoint, status, created_at, started_at, finished_at, result, error FROM jobs WHERE id = ?",
+            (job_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(("id", "endpoint", "status", "created_at", "started_at", "finished_at"), row[:6]))
+        if row[6] is not None:
+            job["result"] = json.loads(row[6])
+        if row[7] is not None:
+            job["error"] = json.loads(row[7])
+        return job
+
+    def submitter(self, job_id: str) -> Optional[str]:
+        """API key the job was submitted with"""
+        row = self._db.execute("SELECT api_key FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row[0] if row else None
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            self._enqueued.discard(job_id)
+            # Claim the job atomically: other workers sharing the database may hold it in their queues too
+            now = time.time()
+            claimed = self._db.execute(
+                "UPDATE jobs SET status = 'running', started_at = ?, owner = ?, lease_until = ? "
+                "WHERE id = ? AND status = 'queued'",
+                (now, self.owner, now + self.lease, job_id),
+            ).rowcount
+            self._db.commit()
+            if claimed:
+                row = self._db.execute(
+                    "SELECT endpoint, payload, api_key, priority FROM jobs WHERE id = ?", (job_id,)
+                ).fetchone()
+                await self._run(job_id, *row)
+
+    async def _run(self, job_id: str, endpoint: str, payload_json: str, api_key: Optional[str], priority: int):
+        payload = json.loads(payload_json)
+        payload["stream"] = True
+        model = payload["model"]
+        if endpoint == "chat":
+            prompt_length = sum(len(msg.get("content", "")) for msg in payload["messages"])
+        else:
+            prompt_length = len(payload["prompt"])
+        start_time = time.time()
+        live = self.live[job_id] = LiveJob()
+        chunks = []
+        first_at = None
+        flight = single_flight.subscribe(None, stream_upstream(endpoint, model, payload, None, priority))
+        try:
+            async for line in flight.iterate():
+                if first_at is None:
+                    first_at = time.time()
+                chunks.append(json.loads(line))
+                await live.append(line)
+            if not chunks:
+                raise RuntimeError("Upstream call finished without a result")
+            result = assemble_stream_result(endpoint, chunks)
+        except asyncio.CancelledError:
+            # Shutting down: close() hands the job back to the queue
+            raise
+        except Exception as e:
+            if isinstance(e, HTTPException):
+                error = {"status": e.status_code, "detail": e.detail}
+            elif isinstance(e, httpx.HTTPStatusError):
+                error = {"status": e.response.status_code, "detail": e.response.text}
+            else:
+                error = {"status": 500, "detail": str(e)}
+            self._finish(job_id, "failed", None, error)
+            self.failed += 1
+        else:
+            self._finish(job_id, "completed", result, None)
+            self.completed += 1
+            await rate_limiter.charge_tokens(api_key, result)
+            log_request(endpoint, model, prompt_length, time.time() - start_time, flight.queue_time, result,
+                        ttft=first_at - start_time if first_at is not None else None)
+        finally:
+            await live.finish()
+            del self.live[job_id]
+
+    def _finish(self, job_id: str, status: str, result: Optional[Dict[str, Any]], error: Optional[Dict[str, Any]]):
+        now = time.time()
+        self._db.execute(
+            "UPDATE jobs SET status = ?, finished_at = ?, result = ?, error = ? WHERE id = ?",
+            (status, now, json.dumps(result) if result is not None else None,
+             json.dumps(error) if error is not None else None, job_id),
+        )
+        self._db.execute("DELETE FROM jobs WHERE finished_at < ?", (now - self.retention,))
+        self._db.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "queued": self._queue.qsize(),
+            "running": len(self.live),
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "recovered_on_start": self.recovered,
+            "expired_leases": self.expired_leases,
+        }
+
+jobs = JobQueue(JOBS_DB, JOB_WORKERS, JOB_RETENTION, JOB_LEASE)
+
+class VectorCache:
+    """Embedding vectors keyed by a hash of model, dimensions and text.
+
+    Each model's vectors are rows of a float32 memory-mapped file, so a hit
+    costs one row copy and no JSON. A SQLite index maps keys to rows and is
+    shared with other worker processes. A full file is reused as a ring,
+    overwriting its oldest rows.
+    """
+
+    INITIAL_ROWS = 1024
+
+    def __init__(self, directory: str, max_vectors: int):
+        self.directory = directory
+        self.max_vectors = max_vectors
+        self._db: Optional[sqlite3.Connection] = None
+        self._maps: Dict[str, Any] = {}  # file name -> np.memmap
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.overwritten = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._db is not None
+
+    def open(self):
+        if not self.directory or self.max_vectors <= 0:
+            return
+        if np is None:
+            print("⚠️  numpy is not installed; embedding vector cache disabled")
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._db = connect_sqlite(os.path.join(self.directory, "index.db"))
+        self._db.isolation_level = None  # explicit transactions below
+        self._db.execute("CREATE TABLE IF NOT EXISTS vectors "
+                         "(key BLOB PRIMARY KEY, file TEXT NOT NULL, row INTEGER NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS vectors_by_row ON vectors (file, row)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, model TEXT NOT NULL, "
+                         "dim INTEGER NOT NULL, rows INTEGER NOT NULL, next INTEGER NOT NULL)")
+
+    def close(self):
+        for vectors in self._maps.values():
+            vectors.flush()
+        self._maps.clear()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    @staticmethod
+    def key(model: str, text: str, dimensions: Optional[int] = None) -> bytes:
+        return hashlib.sha256(f"{model_tag(model)}\0{dimensions or 0}\0{text}".encode("utf-8")).digest()
+
+    def _map(self, name: str, dim: int, rows: int):
+        """The file's rows as a writable float32 matrix, grown (doubling) to hold at least `rows`"""
+        vectors = self._maps.get(name)
+        if vectors is not None and vectors.shape[0] >= rows:
+            return vectors
+        path = os.path.join(self.directory, name)
+        capacity = os.path.getsize(path) // (dim * 4) if os.path.exists(path) else 0
+        if capacity < rows:
+            capacity = min(self.max_vectors, max(rows, capacity * 2, self.INITIAL_ROWS))
+            with open(path, "a+b") as f:
+                f.truncate(capacity * dim * 4)
+        vectors = self._maps[name] = np.memmap(path, dtype=np.float32, mode="r+", shape=(capacity, dim))
+        return vectors
+
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, Any]:
+        found = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = self._db.execute(
+                "SELECT v.key, v.file, v.row, f.dim FROM vectors v JOIN files f ON f.name = v.file "
+                f"WHERE v.key IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+            for key, name, row, dim in rows:
+                found[key] = np.array(self._map(name, dim, row + 1)[row])
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, model: str, keys: List[bytes], vectors: Any):
+        """Store a (len(keys), dim) batch of vectors, overwriting the oldest rows once the file is full"""
+        vectors = np.asarray(vectors, dtype=np.float32)[-self.max_vectors:]
+        keys = keys[-self.max_vectors:]
+        dim = vectors.shape[1]
+        name = f"{hashlib.sha1(model_tag(model).encode()).hexdigest()[:16]}-{dim}.f32"
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._db.execute("SELECT rows, next FROM files WHERE name = ?", (name,)).fetchone()
+            used, position = row or (0, 0)
+            rows = [(position + i) % self.max_vectors for i in range(len(keys))]
+            reused = [r for r in rows if r < used]
+            for start in range(0, len(reused), 500):
+                chunk = reused[start:start + 500]
+                self._db.execute(f"DELETE FROM vectors WHERE file = ? AND row IN ({','.join('?' * len(chunk))})",
+                                 [name, *chunk])
+            used = min(self.max_vectors, used + len(keys) - len(reused))
+            # Vectors are written before the index rows that point at them are committed
+            self._map(name, dim, used)[rows] = vectors
+            self._db.executemany("INSERT OR REPLACE INTO vectors (key, file, row) VALUES (?, ?, ?)",
+                                 [(key, name, r) for key, r in zip(keys, rows)])
+            self._db.execute("INSERT OR REPLACE INTO files (name, model, dim, rows, next) VALUES (?, ?, ?, ?, ?)",
+                             (name, model_tag(model), dim, used, (rows[-1] + 1) % self.max_vectors))
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self.stored += len(keys)
+        self.overwritten += len(reused)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        stats = {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "stored": self.stored,
+            "overwritten": self.overwritten,
+        }
+        if self.enabled:
+            stats["models"] = {model: {"dimensions": dim, "vectors": rows, "bytes": rows * dim * 4}
+                               for model, dim, rows in self._db.execute("SELECT model, dim, rows FROM files")}
+        return stats
+
+vector_cache = VectorCache(EMBED_CACHE_DIR, EMBED_CACHE_MAX_VECTORS)
+
+def chunk_text(text: str, size: int, overlap: int) -> List[str]:
+    """Split text into chunks of about `size` characters, overlapping by `overlap`.
+
+    Chunks end at a paragraph, sentence or word break when one falls in
+    their second half.
+    """
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + size)
+        if end < len(text):
+            for separator in ("\n\n", "\n", ". ", " "):
+                cut = text.rfind(separator, start + size // 2, end)
+                if cut > 0:
+                    end = cut + len(separator)
+                    break
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= len(text):
+            break
+        start = max(start + 1, end - overlap)
+        space = text.find(" ", start, end)
+        if space != -1 and overlap:
+            start = space + 1  # overlap starts on a word
+    return chunks
+
+class VectorIndex:
+    """One retrieval index: L2-normalized chunk vectors as rows of a memory-mapped float32 file.
+
+    Search is brute force. Cosine similarity is a matrix-vector product,
+    computed block by block so memory stays flat as the index grows. Only
+    search() depends on this layout, so an IVF or HNSW structure can replace it.
+    """
+
+    def __init__(self, name: str, model: str, dim: int, path: str, block_rows: int):
+        self.name = name
+        self.model = model
+        self.dim = dim
+        self.path = path
+        self.block_rows = block_rows
+        self._matrix = None
 
-app = FastAPI(title="Ollama Proxy Server", version="1.0.0")
+    def matrix(self, rows: int):
+        """The first `rows` vectors; the mapping is reopened when another writer has grown the file"""
+        if rows == 0:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        if self._matrix is None or self._matrix.shape[0] < rows:
+            self._matrix = np.memmap(self.path, dtype=np.float32, mode="r+", shape=(rows, self.dim))
+        return self._matrix[:rows]
+
+    def append(self, rows: int, vectors):
+        with open(self.path, "a+b") as f:
+            f.truncate(rows * self.dim * 4)  # drops anything a failed write left past the committed rows
+            f.write(vectors.tobytes())
+
+    def search(self, query, rows: int, k: int) -> List[tuple]:
+        """The k best (row, cosine similarity) pairs, best first"""
+        matrix = self.matrix(rows)
+        best_rows = np.zeros(0, dtype=np.int64)
+        best_scores = np.zeros(0, dtype=np.float32)
+        for start in range(0, rows, self.block_rows):
+            scores = matrix[start:start + self.block_rows] @ query
+            if len(scores) > k:
+                top = np.argpartition(scores, -k)[-k:]
+                scores = scores[top]
+            else:
+                top = np.arange(len(scores))
+            best_rows = np.concatenate([best_rows, top + start])
+            best_scores = np.concatenate([best_scores, scores])
+            if len(best_scores) > k:
+                keep = np.argpartition(best_scores, -k)[-k:]
+                best_rows, best_scores = best_rows[keep], best_scores[keep]
+        order = np.argsort(-best_scores)
+        return [(int(best_rows[i]), float(best_scores[i])) for i in order]
+
+class RetrievalStore:
+    """Named vector indexes with their chunk text and metadata in SQLite, shared with other worker processes.
+
+    Indexes are memory-mapped at startup, so they open in constant time
+    whatever their size. Re-indexing a document replaces its chunks. The old
+    rows are zeroed and dropped from results rather than compacted away.
+    """
+
+    def __init__(self, directory: str, chunk_chars: int, chunk_overlap: int, block_rows: int):
+        self.directory = directory
+        self.chunk_chars = chunk_chars
+        self.chunk_overlap = chunk_overlap
+        self.block_rows = block_rows
+        self._db: Optional[sqlite3.Connection] = None
+        self._indexes: Dict[str, VectorIndex] = {}
+        self.queries = 0
+        self.search_time = 0.0
+        self.indexed_chunks = 0
+        self.unchanged_documents = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._db is not None
+
+    def open(self):
+        if not self.directory:
+            return
+        if np is None:
+            print("⚠️  numpy is not installed; /rag endpoints disabled")
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._db = connect_sqlite(os.path.join(self.directory, "index.db"))
+        self._db.isolation_level = None  # explicit transactions below
+        self._db.execute("CREATE TABLE IF NOT EXISTS indexes "
+                         "(name TEXT PRIMARY KEY, model TEXT NOT NULL, dim INTEGER NOT NULL, rows INTEGER NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS documents "
+                         "(idx TEXT NOT NULL, id TEXT NOT NULL, hash BLOB NOT NULL, PRIMARY KEY (idx, id))")
+        self._db.execute("CREATE TABLE IF NOT EXISTS chunks (idx TEXT NOT NULL, row INTEGER NOT NULL, "
+                         "doc_id TEXT NOT NULL, text TEXT NOT NULL, metadata TEXT, PRIMARY KEY (idx, row))")
+        self._db.execute("CREATE INDEX IF NOT EXISTS chunks_by_document ON chunks (idx, doc_id)")
+        names = [name for name, in self._db.execute("SELECT name FROM indexes")]
+        for name in names:
+            self.index(name)
+        if names:
+            print(f"✅ Mapped {len(names)} retrieval index(es)")
+
+    def close(self):
+        self._indexes.clear()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def index(self, name: str) -> Optional[VectorIndex]:
+        index = self._indexes.get(name)
+        if index is None:
+            row = self._db.execute("SELECT model, dim FROM indexes WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                return None
+            path = os.path.join(self.directory, f"{hashlib.sha1(name.encode()).hexdigest()[:16]}.f32")
+            index = self._indexes[name] = VectorIndex(name, row[0], row[1], path, self.block_rows)
+        return index
+
+    def _rows(self, name: str) -> int:
+        return self._db.execute("SELECT rows FROM indexes WHERE name = ?", (name,)).fetchone()[0]
+
+    async def add(self, name: str, model: str, documents: List["RagDocument"], chunk_chars: Optional[int],
+                  chunk_overlap: Optional[int], api_key: Optional[str], priority: int,
+                  http_request: Optional[Request] = None) -> Dict[str, Any]:
+        index = self.index(name)
+        if index is not None and model_tag(index.model) != model_tag(model):
+            raise HTTPException(status_code=409, detail=f"Index '{name}' was built with {index.model}")
+        size = chunk_chars or self.chunk_chars
+        overlap = min(chunk_overlap if chunk_overlap is not None else self.chunk_overlap, size // 2)
+        pending = []  # (doc_id, hash, metadata, chunks)
+        for document in documents:
+            digest = hashlib.sha256(f"{size}\0{overlap}\0{document.text}".encode("utf-8")).digest()
+            doc_id = document.id or digest.hex()[:16]
+            known = self._db.execute("SELECT hash FROM documents WHERE idx = ? AND id = ?", (name, doc_id)).fetchone()
+            if known is not None and known[0] == digest:
+                self.unchanged_documents += 1
+                continue
+            pending.append((doc_id, digest, document.metadata, chunk_text(document.text, size, overlap)))
+        texts = [chunk for *_, chunks in pending for chunk in chunks]
+        if not texts:
+            return {"index": name, "documents": len(pending), "unchanged": len(documents) - len(pending),
+                    "chunks": 0, "embeddings_cached": 0}
+        vectors, embed_stats = await embed_texts(model, texts, {}, api_key, priority, http_request)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            if index is None:
+                self._db.execute("INSERT OR IGNORE INTO indexes (name, model, dim, rows) VALUES (?, ?, ?, 0)",
+                                 (name, model, vectors.shape[1]))
+                index = self.index(name)
+            if vectors.shape[1] != index.dim:
+                raise HTTPException(status_code=409, detail=f"Index '{name}' holds {index.dim}-dimensional vectors")
+            rows = self._rows(name)
+            ids = [doc_id for doc_id, *_ in pending]
+            placeholders = ",".join("?" * len(ids))
+            replaced = [row for row, in self._db.execute(
+                f"SELECT row FROM chunks WHERE idx = ? AND doc_id IN ({placeholders})", [name, *ids])]
+            if replaced:
+                index.matrix(rows)[replaced] = 0.0
+                self._db.execute(f"DELETE FROM chunks WHERE idx = ? AND doc_id IN ({placeholders})", [name, *ids])
+            index.append(rows, vectors)
+            chunk_rows = []
+            for doc_id, digest, metadata, chunks in pending:
+                meta = json.dumps(metadata) if metadata is not None else None
+                first = rows + len(chunk_rows)
+                chunk_rows.extend((name, first + i, doc_id, chunk, meta) for i, chunk in enumerate(chunks))
+                self._db.execute("INSERT OR REPLACE INTO documents (idx, id, hash) VALUES (?, ?, ?)",
+                                 (name, doc_id, digest))
+            self._db.executemany("INSERT INTO chunks (idx, row, doc_id, text, metadata) VALUES (?, ?, ?, ?, ?)",
+                                 chunk_rows)
+            self._db.execute("UPDATE indexes SET rows = ? WHERE name = ?", (rows + len(texts), name))
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            self._indexes.pop(name, None)  # may describe an index the rollback undid
+            raise
+        self.indexed_chunks += len(texts)
+        return {"index": name, "documents": len(pending), "unchanged": len(documents) - len(pending),
+                "chunks": len(texts), "replaced_chunks": len(replaced),
+                "embeddings_cached": embed_stats["cached"]}
+
+    def query(self, index: VectorIndex, vector, k: int) -> List[Dict[str, Any]]:
+        """The k chunks most similar to `vector`, best first"""
+        start = time.perf_counter()
+        query = np.asarray(vector, dtype=np.float32)
+        query /= max(float(np.linalg.norm(query)), 1e-12)
+        # Rows of replaced documents are zeroed but still scanned; asking for extra covers the ones that surface
+        hits = index.search(query, self._rows(index.name), k * 2)
+        self.search_time += time.perf_counter() - start
+        self.queries += 1
+        if not hits:
+            return []
+        scores = dict(hits)
+        found = self._db.execute(
+            f"SELECT row, doc_id, text, metadata FROM chunks WHERE idx = ? AND row IN ({','.join('?' * len(hits))})",
+            [index.name, *scores]).fetchall()
+        chunks = [{"document": doc_id, "text": text, "score": round(scores[row], 4),
+                   "metadata": json.loads(metadata) if metadata else None}
+                  for row, doc_id, text, metadata in found]
+        chunks.sort(key=lambda chunk: chunk["score"], reverse=True)
+        return chunks[:k]
+
+    def stats(self) -> Dict[str, Any]:
+        stats = {
+            "enabled": self.enabled,
+            "queries": self.queries,
+            "avg_search_ms": round(self.search_time * 1000 / self.queries, 3) if self.queries else None,
+            "indexed_chunks": self.indexed_chunks,
+            "unchanged_documents": self.unchanged_documents,
+        }
+        if self.enabled:
+            stats["indexes"] = {
+                name: {"model": model, "dimensions": dim, "rows": rows, "bytes": rows * dim * 4,
+                       "documents": self._db.execute("SELECT COUNT(*) FROM documents WHERE idx = ?",
+                                                     (name,)).fetchone()[0]}
+                for name, model, dim, rows in self._db.execute("SELECT name, model, dim, rows FROM indexes").fetchall()
+            }
+        return stats
+
+retrieval = RetrievalStore(RAG_DIR, RAG_CHUNK_CHARS, RAG_CHUNK_OVERLAP, RAG_SEARCH_BLOCK)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open shared upstream resources at startup and release them at shutdown"""
+    await upstream.start()
+    await balancer.start()
+    await residency.start()
+    response_cache.open()
+    rate_limiter.store = create_rate_limit_store(RATE_LIMIT_BACKEND)
+    jobs.open()
+    sessions.open()
+    vector_cache.open()
+    retrieval.open()
+    shared_state.open()
+    try:
+        yield
+    finally:
+        await shared_state.close()
+        retrieval.close()
+        vector_cache.close()
+        await sessions.close()
+        await jobs.close()
+        await rate_limiter.store.close()
+        response_cache.close()
+        await residency.stop()
+        await balancer.stop()
+        await upstream.close()
+
+app = FastAPI(title="Ollama Proxy Server", version="1.0.0", lifespan=lifespan)
 
 # Enable CORS for web interface access
 app.add_middleware(
@@ -25,44 +2831,645 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Configuration
-OLLAMA_BASE_URL = "http://localhost:11434"
-REQUEST_TIMEOUT = 300
+class ModelOptions(BaseModel):
+    """Ollama runtime options, forwarded under `options`; unknown names are rejected rather than ignored"""
+    model_config = ConfigDict(extra="forbid")
 
-class GenerateRequest(BaseModel):
+    num_predict: Optional[int] = Field(None, ge=-2, description="Max tokens to generate (-1 unlimited, -2 fill context)")
+    num_ctx: Optional[int] = Field(None, ge=1)
+    num_keep: Optional[int] = None
+    num_batch: Optional[int] = Field(None, ge=1)
+    num_gpu: Optional[int] = None
+    main_gpu: Optional[int] = None
+    num_thread: Optional[int] = Field(None, ge=0)
+    seed: Optional[int] = None
+    temperature: Optional[float] = Field(None, ge=0)
+    top_k: Optional[int] = Field(None, ge=0)
+    top_p: Optional[float] = Field(None, ge=0, le=1)
+    min_p: Optional[float] = Field(None, ge=0, le=1)
+    typical_p: Optional[float] = Field(None, ge=0, le=1)
+    repeat_last_n: Optional[int] = Field(None, ge=-1)
+    repeat_penalty: Optional[float] = None
+    presence_penalty: Optional[float] = None
+    frequency_penalty: Optional[float] = None
+    penalize_newline: Optional[bool] = None
+    mirostat: Optional[int] = Field(None, ge=0, le=2)
+    mirostat_tau: Optional[float] = None
+    mirostat_eta: Optional[float] = None
+    stop: Optional[List[str]] = None
+    numa: Optional[bool] = None
+    use_mmap: Optional[bool] = None
+
+class CompletionRequest(BaseModel):
+    """Fields shared by /generate and /chat.
+
+    `temperature`, `top_p`, `max_tokens` and `seed` are accepted at the top
+    level for compatibility and moved into `options` (`max_tokens` becomes
+    `num_predict`); values given in `options` take precedence.
+    """
     model: str
-    prompt: str
     stream: bool = False
-    temperature: Optional[float] = None
-    top_p: Optional[float] = None
-    max_tokens: Optional[int] = None
+    options: Optional[ModelOptions] = None
+    keep_alive: Optional[Union[int, str]] = None
+    format: Optional[Union[str, Dict[str, Any]]] = None
+    temperature: Optional[float] = Field(None, ge=0)
+    top_p: Optional[float] = Field(None, ge=0, le=1)
+    max_tokens: Optional[int] = Field(None, ge=-2)
+    seed: Optional[int] = None
+    session_id: Optional[str] = Field(None, description="Continue a conversation created with POST /sessions")
+
+    LEGACY_OPTIONS: ClassVar[Dict[str, str]] = {
+        "temperature": "temperature", "top_p": "top_p", "max_tokens": "num_predict", "seed": "seed",
+    }
+
+    def to_payload(self) -> Dict[str, Any]:
+        """The request body Ollama expects"""
+        payload = self.model_dump(exclude_none=True, exclude={"session_id", *self.LEGACY_OPTIONS})
+        options = {self.LEGACY_OPTIONS[name]: getattr(self, name)
+                   for name in self.LEGACY_OPTIONS if getattr(self, name) is not None}
+        options.update(payload.pop("options", {}))
+        if options:
+            payload["options"] = options
+        return payload
+
+class GenerateRequest(CompletionRequest):
+    prompt: str
+    system: Optional[str] = None
+    raw: Optional[bool] = None
 
 class ChatMessage(BaseModel):
     role: str
     content: str
 
-class ChatRequest(BaseModel):
-    model: str
+class ChatRequest(CompletionRequest):
     messages: List[ChatMessage]
-    stream: bool = False
-    temperature: Optional[float] = None
+
+class SessionRequest(BaseModel):
+    model: Optional[str] = Field(None, description="Model used to summarize old turns")
+    system: Optional[str] = None
+    token_budget: Optional[int] = Field(None, ge=0, description="Max prompt tokens of history sent per turn")
+    summarize: Optional[bool] = Field(None, description="Summarize turns that leave the window instead of dropping them")
+
+class EmbedRequest(BaseModel):
+    model: str
+    input: Union[str, List[str]]
+    truncate: Optional[bool] = None
+    dimensions: Optional[int] = Field(None, ge=1)
+    options: Optional[ModelOptions] = None
+    keep_alive: Optional[Union[int, str]] = None
+
+class RagDocument(BaseModel):
+    id: Optional[str] = Field(None, description="Re-indexing an id replaces its chunks; defaults to a hash of the text")
+    text: str
+    metadata: Optional[Dict[str, Any]] = None
+
+class RagIndexRequest(BaseModel):
+    index: str = "default"
+    model: str = Field(..., description="Embedding model; fixed for the index once created")
+    documents: List[RagDocument]
+    chunk_chars: Optional[int] = Field(None, ge=100)
+    chunk_overlap: Optional[int] = Field(None, ge=0)
+
+class RagQueryRequest(GenerateRequest):
+    """A /generate request whose prompt is answered from the top_k chunks of an index"""
+    index: str = "default"
+    top_k: int = Field(4, ge=1, le=100)
+    generate: bool = Field(True, description="False returns the chunks and assembled prompt without generating")
+
+    RAG_FIELDS: ClassVar[set] = {"index", "top_k", "generate"}
+
+    def to_payload(self) -> Dict[str, Any]:
+        payload = super().to_payload()
+        for name in self.RAG_FIELDS:
+            payload.pop(name, None)
+        return payload
+
+class JobRequest(BaseModel):
+    endpoint: Literal["generate", "chat"] = "generate"
+    request: Dict[str, Any]
 
 # Request logging
-request_log = []
+class RequestLog:
+    """Fixed-size ring buffer of requests with aggregates maintained on insert and evict"""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        # Columnar, preallocated storage: numbers in typed arrays, strings by reference
+        self._timestamp = array("d", bytes(8 * capacity))
+        self._response_time = array("d", bytes(8 * capacity))
+        self._queue_time = array("d", bytes(8 * capacity))
+        self._ttft = array("d", bytes(8 * capacity))
+        self._prompt_length = array("q", bytes(8 * capacity))
+        self._prompt_tokens = array("q", bytes(8 * capacity))
+        self._completion_tokens = array("q", bytes(8 * capacity))
+        self._endpoint: List[Optional[str]] = [None] * capacity
+        self._model: List[Optional[str]] = [None] * capacity
+        self._next = 0
+        self._count = 0
+        self.lifetime_requests = 0
+        self.total_response_time = 0.0
+        self.total_queue_time = 0.0
+        self.total_prompt_tokens = 0
+        self.total_completion_tokens = 0
+        self.models_used: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, timestamp: float, endpoint: str, model: str, prompt_length: int,
+               response_time: float, queue_time: float, ttft: Optional[float] = None,
+               prompt_tokens: int = 0, completion_tokens: int = 0):
+        i = self._next
+        if self._count == self.capacity:
+            # Evict the oldest entry from the running aggregates
+            self.total_response_time -= self._response_time[i]
+            self.total_queue_time -= self._queue_time[i]
+            self.total_prompt_tokens -= self._prompt_tokens[i]
+            self.total_completion_tokens -= self._completion_tokens[i]
+            old_model = self._model[i]
+            self.models_used[old_model] -= 1
+            if not self.models_used[old_model]:
+                del self.models_used[old_model]
+        else:
+            self._count += 1
+        self._timestamp[i] = timestamp
+        self._endpoint[i] = endpoint
+        self._model[i] = model
+        self._prompt_length[i] = prompt_length
+        self._response_time[i] = response_time
+        self._queue_time[i] = queue_time
+        self._ttft[i] = -1.0 if ttft is None else ttft
+        self._prompt_tokens[i] = prompt_tokens
+        self._completion_tokens[i] = completion_tokens
+        self.total_response_time += response_time
+        self.total_queue_time += queue_time
+        self.total_prompt_tokens += prompt_tokens
+        self.total_completion_tokens += completion_tokens
+        self.models_used[model] = self.models_used.get(model, 0) + 1
+        self.lifetime_requests += 1
+        self._next = (i + 1) % self.capacity
+
+    def record(self, i: int) -> Dict[str, Any]:
+        return {
+            "timestamp": self._timestamp[i],
+            "endpoint": self._endpoint[i],
+            "model": self._model[i],
+            "prompt_length": self._prompt_length[i],
+            "response_time": self._response_time[i],
+            "queue_time": self._queue_time[i],
+            "generation_time": self._response_time[i] - self._queue_time[i],
+            "time_to_first_token": None if self._ttft[i] < 0 else self._ttft[i],
+            "prompt_tokens": self._prompt_tokens[i],
+            "completion_tokens": self._completion_tokens[i],
+        }
+
+    def recent(self, n: int) -> List[Dict[str, Any]]:
+        """The last `n` requests, oldest first"""
+        n = min(n, self._count)
+        return [self.record((self._next - n + k) % self.capacity) for k in range(n)]
+
+request_log = RequestLog(REQUEST_LOG_SIZE)
+
+class LatencyHistogram:
+    """Log-bucketed histogram (about 2% relative error) over sliding time windows.
+
+    Samples land in sparse per-slice bucket maps: 10 s slices back the 1 and
+    5 minute windows, 1 min slices back the 1 hour window.
+    """
+
+    GROWTH = 1.04
+    MIN_VALUE = 1e-6
+    TIERS = ((10, 30), (60, 60))  # (slice width in seconds, slices kept)
+    WINDOWS = {"1m": 60, "5m": 300, "1h": 3600}
+
+    def __init__(self):
+        self._tiers: List[Dict[int, Dict[int, int]]] = [{} for _ in self.TIERS]
+        self.count = 0
+        self.total = 0.0
+
+    def _bucket(self, value: float) -> int:
+        return math.floor(math.log(max(value, self.MIN_VALUE), self.GROWTH))
+
+    def record(self, value: float, now: Optional[float] = None):
+        now = time.time() if now is None else now
+        bucket = self._bucket(value)
+        for (width, keep), slices in zip(self.TIERS, self._tiers):
+            index = int(now // width)
+            counts = slices.get(index)
+            if counts is None:
+                counts = slices[index] = {}
+                for old in [i for i in slices if i <= index - keep]:
+                    del slices[old]
+            counts[bucket] = counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+
+    def window(self, seconds: float, now: Optional[float] = None) -> Dict[int, int]:
+        """Merged bucket counts for samples newer than `seconds`"""
+        now = time.time() if now is None else now
+        for (width, keep), slices in zip(self.TIERS, self._tiers):
+            if seconds <= width * keep:
+                break
+        oldest = int((now - seconds) // width)
+        merged: Dict[int, int] = {}
+        for index, counts in slices.items():
+            if index > oldest:
+                for bucket, n in counts.items():
+                    merged[bucket] = merged.get(bucket, 0) + n
+        return merged
+
+    def summary(self, seconds: float, now: Optional[float] = None) -> Optional[Dict[str, float]]:
+        """count and p50/p90/p99/p999 for a window, or None when it is empty"""
+        merged = self.window(seconds, now)
+        count = sum(merged.values())
+        if not count:
+            return None
+        result: Dict[str, float] = {"count": count}
+        targets = (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("p999", 0.999))
+        seen, t = 0, 0
+        for bucket in sorted(merged):
+            seen += merged[bucket]
+            while t < len(targets) and seen >= targets[t][1] * count:
+                result[targets[t][0]] = round(self.GROWTH ** (bucket + 0.5), 4)
+                t += 1
+        return result
+
+class LatencyStats:
+    """Histograms of total time, time-to-first-token and tokens/sec per endpoint and per model"""
+
+    def __init__(self):
+        self._series: Dict[tuple, LatencyHistogram] = {}
 
-def log_request(endpoint: str, model: str, prompt_length: int, response_time: float):
+    def _record(self, scope: str, name: str, metric: str, value: float, now: float):
+        key = (scope, name, metric)
+        histogram = self._series.get(key)
+        if histogram is None:
+            histogram = self._series[key] = LatencyHistogram()
+        histogram.record(value, now)
+
+    def record(self, endpoint: str, model: str, total_time: float,
+               ttft: Optional[float] = None, tokens_per_sec: Optional[float] = None):
+        now = time.time()
+        for scope, name in (("endpoints", endpoint), ("models", model)):
+            self._record(scope, name, "total_time", total_time, now)
+            if ttft is not None:
+                self._record(scope, name, "ttft", ttft, now)
+            if tokens_per_sec is not None:
+                self._record(scope, name, "tokens_per_sec", tokens_per_sec, now)
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.time()
+        report: Dict[str, Any] = {"endpoints": {}, "models": {}}
+        for (scope, name, metric), histogram in sorted(self._series.items()):
+            windows = {}
+            for label, seconds in LatencyHistogram.WINDOWS.items():
+                summary = histogram.summary(seconds, now)
+                if summary is not None:
+                    windows[label] = summary
+            if windows:
+                report[scope].setdefault(name, {})[metric] = windows
+        return report
+
+latency_stats = LatencyStats()
+
+def generation_metrics(result: Optional[Dict[str, Any]], queue_time: float) -> tuple:
+    """Time-to-first-token and tokens/sec derived from Ollama's final response stats"""
+    if not result:
+        return None, None
+    ttft = None
+    if "prompt_eval_duration" in result or "load_duration" in result:
+        ttft = queue_time + (result.get("load_duration", 0) + result.get("prompt_eval_duration", 0)) / 1e9
+    tokens_per_sec = None
+    if result.get("eval_count") and result.get("eval_duration"):
+        tokens_per_sec = result["eval_count"] / (result["eval_duration"] / 1e9)
+    return ttft, tokens_per_sec
+
+def log_request(endpoint: str, model: str, prompt_length: int, response_time: float, queue_time: float = 0.0,
+                result: Optional[Dict[str, Any]] = None, ttft: Optional[float] = None):
     """Log API requests for monitoring"""
-    request_log.append({
-        "timestamp": time.time(),
-        "endpoint": endpoint,
-        "model": model,
-        "prompt_length": prompt_length,
-        "response_time": response_time
-    })
-    
-    # Keep only last 100 requests
-    if len(request_log) > 100:
-        request_log.pop(0)
+    derived_ttft, tokens_per_sec = generation_metrics(result, queue_time)
+    ttft = ttft if ttft is not None else derived_ttft
+    prompt_tokens = (result or {}).get("prompt_eval_count") or 0
+    completion_tokens = (result or {}).get("eval_count") or 0
+    request_log.append(time.time(), endpoint, model, prompt_length, response_time, queue_time,
+                       ttft, prompt_tokens, completion_tokens)
+    latency_stats.record(endpoint, model, response_time, ttft, tokens_per_sec)
+    residency.observe(model, result, ttft)
+    if prompt_tokens:
+        token_counter.observe(model, prompt_length, prompt_tokens)
+    metrics.observe_generation(endpoint, model, response_time, queue_time, ttft, result)
+
+# Prometheus metrics
+class PromHistogram:
+    """Cumulative Prometheus histogram with fixed buckets, one row per label set"""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self):
+        self._rows: Dict[tuple, list] = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, labels: tuple, value: float):
+        row = self._rows.get(labels)
+        if row is None:
+            row = self._rows[labels] = [0] * len(self.BUCKETS) + [0.0, 0]
+        index = bisect_left(self.BUCKETS, value)
+        if index < len(self.BUCKETS):
+            row[index] += 1
+        row[-2] += value
+        row[-1] += 1
+
+    def render(self, name: str, label_names: tuple, lines: List[str]):
+        for labels, row in list(self._rows.items()):
+            base = format_labels(label_names, labels)
+            cumulative = 0
+            for bound, n in zip(self.BUCKETS, row):
+                cumulative += n
+                lines.append(f'{name}_bucket{{{base},le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{base},le="+Inf"}} {row[-1]}')
+            lines.append(f"{name}_sum{{{base}}} {row[-2]}")
+            lines.append(f"{name}_count{{{base}}} {row[-1]}")
+
+def format_labels(names: tuple, values: tuple) -> str:
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return ",".join(f'{n}="{v}"' for n, v in zip(names, escaped))
+
+class Metrics:
+    """Counters updated inline on the request path; gauges are read from components at scrape time"""
+
+    def __init__(self):
+        self.http_in_flight = 0
+        self.http_requests: Dict[tuple, int] = {}  # (route, method, status) -> count
+        self.generations: Dict[tuple, int] = {}  # (endpoint, model) -> count
+        self.prompt_tokens: Dict[str, int] = {}
+        self.generated_tokens: Dict[str, int] = {}
+        self.request_duration = PromHistogram()
+        self.queue_wait = PromHistogram()
+        self.time_to_first_token = PromHistogram()
+
+    def observe_http(self, route: str, method: str, status: int):
+        key = (route, method, status)
+        self.http_requests[key] = self.http_requests.get(key, 0) + 1
+
+    def observe_generation(self, endpoint: str, model: str, response_time: float, queue_time: float,
+                           ttft: Optional[float], result: Optional[Dict[str, Any]]):
+        key = (endpoint, model)
+        self.generations[key] = self.generations.get(key, 0) + 1
+        self.request_duration.observe(key, response_time)
+        self.queue_wait.observe(key, queue_time)
+        if ttft is not None:
+            self.time_to_first_token.observe(key, ttft)
+        if result:
+            self.prompt_tokens[model] = self.prompt_tokens.get(model, 0) + (result.get("prompt_eval_count") or 0)
+            self.generated_tokens[model] = self.generated_tokens.get(model, 0) + (result.get("eval_count") or 0)
+
+    def render(self) -> str:
+        lines: List[str] = []
+
+        def family(name: str, kind: str, help_text: str):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def samples(name: str, label_names: tuple, values: Dict):
+            for labels, value in list(values.items()):
+                labels = labels if isinstance(labels, tuple) else (labels,)
+                lines.append(f"{name}{{{format_labels(label_names, labels)}}} {value}")
+
+        family("ollama_proxy_http_requests_total", "counter", "HTTP requests handled by the proxy")
+        samples("ollama_proxy_http_requests_total", ("route", "method", "status"), self.http_requests)
+        family("ollama_proxy_http_requests_in_flight", "gauge", "HTTP requests currently being served")
+        lines.append(f"ollama_proxy_http_requests_in_flight {self.http_in_flight}")
+        family("ollama_proxy_generations_total", "counter", "Completed generate/chat requests")
+        samples("ollama_proxy_generations_total", ("endpoint", "model"), self.generations)
+        family("ollama_proxy_prompt_tokens_total", "counter", "Prompt tokens evaluated by Ollama")
+        samples("ollama_proxy_prompt_tokens_total", ("model",), self.prompt_tokens)
+        family("ollama_proxy_generated_tokens_total", "counter", "Tokens generated by Ollama")
+        samples("ollama_proxy_generated_tokens_total", ("model",), self.generated_tokens)
+
+        family("ollama_proxy_request_duration_seconds", "histogram", "Total generate/chat latency")
+        self.request_duration.render("ollama_proxy_request_duration_seconds", ("endpoint", "model"), lines)
+        family("ollama_proxy_queue_wait_seconds", "histogram", "Time spent waiting for an upstream slot")
+        self.queue_wait.render("ollama_proxy_queue_wait_seconds", ("endpoint", "model"), lines)
+        family("ollama_proxy_time_to_first_token_seconds", "histogram", "Time to first generated token")
+        self.time_to_first_token.render("ollama_proxy_time_to_first_token_seconds", ("endpoint", "model"), lines)
+
+        family("ollama_proxy_upstream_errors_total", "counter", "Failed upstream calls by backend and status")
+        samples("ollama_proxy_upstream_errors_total", ("backend", "status"), balancer.upstream_errors)
+        family("ollama_proxy_backend_up", "gauge", "Whether a backend is currently admitted")
+        samples("ollama_proxy_backend_up", ("backend",), {b.url: int(b.healthy) for b in balancer.backends})
+        family("ollama_proxy_backend_outstanding", "gauge", "Requests in progress per backend")
+        samples("ollama_proxy_backend_outstanding", ("backend",), {b.url: b.outstanding for b in balancer.backends})
+
+        family("ollama_proxy_upstream_in_flight", "gauge", "Upstream HTTP calls in progress")
+        lines.append(f"ollama_proxy_upstream_in_flight {upstream.in_flight}")
+        family("ollama_proxy_queue_depth", "gauge", "Requests waiting for an upstream slot")
+        lines.append(f"ollama_proxy_queue_depth {scheduler.queue_depth}")
+        family("ollama_proxy_active_generations", "gauge", "Upstream slots in use per model")
+        samples("ollama_proxy_active_generations", ("model",), scheduler.active_by_model)
+        family("ollama_proxy_queue_rejections_total", "counter", "Requests rejected by admission control")
+        samples("ollama_proxy_queue_rejections_total", ("reason",),
+                {"queue_full": scheduler.rejected_full, "timeout": scheduler.rejected_timeout})
+        family("ollama_proxy_rate_limited_total", "counter", "Requests rejected by rate limits")
+        samples("ollama_proxy_rate_limited_total", ("scope",), {"ip": rate_limiter.limited_ip,
+                "key": rate_limiter.limited_key, "tokens": rate_limiter.limited_tokens})
+        family("ollama_proxy_cache_lookups_total", "counter", "Response cache lookups")
+        samples("ollama_proxy_cache_lookups_total", ("result",),
+                {"hit": response_cache.hits, "miss": response_cache.misses})
+        family("ollama_proxy_cache_bytes", "gauge", "Bytes held by the in-memory response cache")
+        lines.append(f"ollama_proxy_cache_bytes {response_cache.size_bytes}")
+        family("ollama_proxy_client_disconnects_total", "counter", "Clients that went away before their response finished")
+        lines.append(f"ollama_proxy_client_disconnects_total {stream_stats.client_disconnects}")
+        family("ollama_proxy_upstream_cancelled_total", "counter", "Upstream generations cancelled because no client was left")
+        lines.append(f"ollama_proxy_upstream_cancelled_total {stream_stats.upstream_cancelled}")
+        family("ollama_proxy_upstream_aborted_total", "counter", "Upstream generations that failed mid-stream")
+        lines.append(f"ollama_proxy_upstream_aborted_total {stream_stats.upstream_aborted}")
+        family("ollama_proxy_backpressure_stalls_total", "counter", "Times a slow client paused an upstream read")
+        lines.append(f"ollama_proxy_backpressure_stalls_total {stream_stats.backpressure_stalls}")
+        family("ollama_proxy_coalesced_requests_total", "counter", "Requests served by another request's upstream call")
+        lines.append(f"ollama_proxy_coalesced_requests_total {single_flight.followers}")
+        lines.append("")
+        return "\n".join(lines)
+
+metrics = Metrics()
+
+class MetricsMiddleware:
+    """Pure ASGI middleware counting requests by route template and final status"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        metrics.http_in_flight += 1
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            metrics.http_in_flight -= 1
+            route = scope.get("route")
+            metrics.observe_http(getattr(route, "path", "unmatched"), scope["method"], status)
+
+app.add_middleware(MetricsMiddleware)
+
+class SharedState:
+    """Per-worker stats and metrics snapshots in a shared SQLite file.
+
+    Each worker publishes its own numbers every few seconds; whichever worker
+    answers /stats or /metrics merges its live numbers with the others'.
+    """
+
+    # Gauges that every worker reports for the same shared thing, so they merge by max instead of sum
+    MAX_MERGED = {"ollama_proxy_backend_up"}
+    # Integer stats that are settings or shared state rather than per-worker counts, and high-water marks
+    SHARED_FIELDS = {"max_connections", "max_keepalive_connections", "global_limit", "per_model_limit",
+                     "max_queue_depth", "max_bytes", "buckets", "buffer_items", "max_batch_size", "default_num_ctx",
+                     "max_sessions", "default_token_budget"}
+    PEAK_FIELDS = {"peak_in_flight", "largest_batch"}
+    _DIFFERS = object()
+
+    def __init__(self, db_path: str, interval: float):
+        self.db_path = db_path
+        self.interval = interval
+        self.pid = os.getpid()
+        self._db: Optional[sqlite3.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._db is not None
+
+    def open(self):
+        if not self.db_path:
+            return
+        self.pid = os.getpid()
+        self._db = connect_sqlite(self.db_path)
+        self._db.execute("CREATE TABLE IF NOT EXISTS worker_stats "
+                         "(pid INTEGER PRIMARY KEY, updated_at REAL NOT NULL, stats TEXT NOT NULL, metrics TEXT NOT NULL)")
+        self._db.commit()
+        self._task = asyncio.create_task(self._publish_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._db is not None:
+            self._db.execute("DELETE FROM worker_stats WHERE pid = ?", (self.pid,))
+            self._db.commit()
+            self._db.close()
+            self._db = None
+
+    async def _publish_loop(self):
+        while True:
+            self.publish()
+            await asyncio.sleep(self.interval)
+
+    def publish(self):
+        self._db.execute("INSERT OR REPLACE INTO worker_stats (pid, updated_at, stats, metrics) VALUES (?, ?, ?, ?)",
+                         (self.pid, time.time(), json.dumps(collect_stats()), metrics.render()))
+        self._db.commit()
+
+    def _others(self) -> List[tuple]:
+        # Rows not refreshed for several intervals belong to workers that have exited
+        cutoff = time.time() - max(3 * self.interval, 10)
+        return self._db.execute("SELECT pid, stats, metrics FROM worker_stats WHERE pid != ? AND updated_at >= ?",
+                                (self.pid, cutoff)).fetchall()
+
+    def merge_stats(self, local: Dict[str, Any]) -> Dict[str, Any]:
+        snapshots = {self.pid: local}
+        snapshots.update({pid: json.loads(stats) for pid, stats, _ in self._others()})
+        total = sum(s.get("total_requests", 0) for s in snapshots.values())
+        models_used: Dict[str, int] = {}
+        recent: List[Dict[str, Any]] = []
+        for snapshot in snapshots.values():
+            for model, count in snapshot.get("models_used", {}).items():
+                models_used[model] = models_used.get(model, 0) + count
+            recent.extend(snapshot.get("recent_requests", []))
+        recent.sort(key=lambda r: r["timestamp"])
+
+        def weighted(field: str, digits: int) -> float:
+            if not total:
+                return 0.0
+            return round(sum(s.get(field, 0) * s.get("total_requests", 0) for s in snapshots.values()) / total, digits)
+
+        return {
+            "workers": len(snapshots),
+            "total_requests": total,
+            "lifetime_requests": sum(s.get("lifetime_requests", 0) for s in snapshots.values()),
+            "window_size": sum(s.get("window_size", request_log.capacity) for s in snapshots.values()),
+            "average_response_time": weighted("average_response_time", 2),
+            "average_queue_time": weighted("average_queue_time", 3),
+            "prompt_tokens": sum(s.get("prompt_tokens", 0) for s in snapshots.values()),
+            "completion_tokens": sum(s.get("completion_tokens", 0) for s in snapshots.values()),
+            "models_used": models_used,
+            "recent_requests": recent[-5:],
+            **{name: self._merge(name, [s[name] for s in snapshots.values() if name in s])
+               for name, value in local.items() if isinstance(value, dict) and name != "models_used"},
+            "per_worker": {str(pid): snapshot for pid, snapshot in sorted(snapshots.items())},
+        }
+
+    @classmethod
+    def _merge(cls, name: str, values: List[Any]) -> Any:
+        """One component stat across workers.
+
+        Counters and in-flight gauges are summed, settings and shared state
+        taken once; averages, rates and percentiles survive only where every
+        worker agrees, and are otherwise left to `per_worker`.
+        """
+        if all(isinstance(v, dict) for v in values):
+            merged = {}
+            for key in dict.fromkeys(k for v in values for k in v):
+                value = cls._merge(key, [v[key] for v in values if key in v])
+                if value is not cls._DIFFERS:
+                    merged[key] = value
+            return merged
+        rows = all(isinstance(v, list) and len(v) == len(values[0]) for v in values)
+        if rows and all(isinstance(item, dict) for v in values for item in v):
+            return [cls._merge(name, list(items)) for items in zip(*values)]
+        counter = name not in cls.SHARED_FIELDS and not name.startswith(("average", "avg"))
+        if counter and all(isinstance(v, int) and not isinstance(v, bool) for v in values):
+            return max(values) if name in cls.PEAK_FIELDS else sum(values)
+        return values[0] if all(v == values[0] for v in values) else cls._DIFFERS
+
+    def merge_metrics(self, local: str) -> str:
+        """Sum every sample across workers' expositions (max for MAX_MERGED gauges)"""
+        values: Dict[str, float] = {}
+        lines: List[str] = []  # HELP/TYPE lines and sample keys in first-seen order
+        for text in [local] + [m for _, _, m in self._others()]:
+            for line in text.splitlines():
+                if not line:
+                    continue
+                if line.startswith("#"):
+                    if line not in values:
+                        values[line] = 0.0
+                        lines.append(line)
+                    continue
+                key, value = line.rsplit(" ", 1)
+                if key not in values:
+                    values[key] = float(value)
+                    lines.append(key)
+                elif key.split("{", 1)[0] in self.MAX_MERGED:
+                    values[key] = max(values[key], float(value))
+                else:
+                    values[key] += float(value)
+        out = ["# HELP ollama_proxy_workers Worker processes contributing to these metrics",
+               "# TYPE ollama_proxy_workers gauge", f"ollama_proxy_workers {1 + len(self._others())}"]
+        for line in lines:
+            if line.startswith("#"):
+                out.append(line)
+            else:
+                value = values[line]
+                out.append(f"{line} {int(value) if value.is_integer() else value}")
+        out.append("")
+        return "\n".join(out)
+
+shared_state = SharedState(SHARED_STATE_DB, SHARED_STATS_INTERVAL)
 
 @app.get("/")
 async def root():
@@ -73,9 +3480,13 @@ async def root():
         "endpoints": {
             "/models": "List available models",
             "/generate": "Generate text",
+            "/generate/batch": "Generate text for many prompts (JSON array or NDJSON)",
             "/chat": "Chat with model",
+            "/jobs": "Queue a background generate/chat job",
+            "/sessions": "Start a server-side conversation (reuses the backend's cached prefix)",
             "/health": "Health check",
             "/stats": "Server statistics",
+            "/metrics": "Prometheus metrics",
             "/web": "Web interface"
         }
     }
@@ -185,119 +3596,683 @@ async def web_interface():
     """
     return HTMLResponse(content=html_content)
 
-@app.get("/health")
-async def health_check():
-    """Check if Ollama server is accessible"""
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{OLLAMA_BASE_URL}/api/tags", timeout=5)
-            return {
-                "status": "healthy" if response.status_code == 200 else "unhealthy",
-                "ollama_server": OLLAMA_BASE_URL,
-                "response_code": response.status_code
-            }
-    except Exception as e:
+# Cached upstream views
+class StaleWhileRevalidate:
+    """A single upstream-derived value, refreshed in the background once older than `ttl`.
+
+    Callers get the cached value immediately while a refresh runs; they only
+    wait when nothing has been fetched yet or the value is older than `max_stale`.
+    """
+
+    def __init__(self, fetch: Callable[[], Awaitable[Any]], ttl: float, max_stale: float):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.value: Any = None
+        self.etag: Optional[str] = None
+        self.fetched_at = 0.0
+        self._refresh: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.stale_hits = 0
+        self.refreshes = 0
+        self.errors = 0
+
+    async def get(self) -> tuple:
+        """(value, etag), fetching synchronously only when there is nothing usable"""
+        age = time.time() - self.fetched_at
+        if self.value is None or age > self.max_stale:
+            await self._start_refresh()
+        elif age > self.ttl:
+            self.stale_hits += 1
+            self._start_refresh()
+        else:
+            self.hits += 1
+        return self.value, self.etag
+
+    def _start_refresh(self) -> asyncio.Task:
+        if self._refresh is None or self._refresh.done():
+            self._refresh = asyncio.create_task(self._run())
+        return self._refresh
+
+    async def _run(self):
+        try:
+            value = await self.fetch()
+        except Exception:
+            self.errors += 1
+            if self.value is None or time.time() - self.fetched_at > self.max_stale:
+                raise
+            return  # keep serving the stale value
+        body = json.dumps(value, sort_keys=True, separators=(",", ":")).encode("utf-8")
+        self.value = value
+        self.etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        self.fetched_at = time.time()
+        self.refreshes += 1
+
+    def stats(self) -> Dict[str, Any]:
         return {
-            "status": "unhealthy",
-            "ollama_server": OLLAMA_BASE_URL,
-            "error": str(e)
+            "ttl": self.ttl,
+            "max_stale": self.max_stale,
+            "age": round(time.time() - self.fetched_at, 1) if self.value is not None else None,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "refreshes": self.refreshes,
+            "errors": self.errors,
         }
 
+def conditional_response(http_request: Request, value: Any, etag: str, max_age: float) -> Response:
+    """JSON response with an ETag, or 304 when the client already holds this version"""
+    headers = {"ETag": etag, "Cache-Control": f"max-age={int(max_age)}"}
+    if_none_match = http_request.headers.get("if-none-match", "")
+    if etag in (tag.strip() for tag in if_none_match.split(",")) or if_none_match.strip() == "*":
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(value, headers=headers)
+
+@app.get("/health")
+async def health_check(http_request: Request):
+    """Backend health as of the load balancer's last probes; does not call Ollama itself"""
+    healthy = [b.url for b in balancer.backends if b.healthy]
+    probes = [b.last_probe for b in balancer.backends if b.last_probe is not None]
+    status = {
+        "status": "healthy" if healthy else "unhealthy",
+        "ollama_servers": [b.url for b in balancer.backends],
+        "healthy_backends": healthy,
+        "checked_at": max(probes) if probes else None,
+    }
+    etag = '"' + hashlib.sha256(json.dumps(status, sort_keys=True).encode("utf-8")).hexdigest()[:32] + '"'
+    return conditional_response(http_request, status, etag, LB_PROBE_INTERVAL)
+
+async def fetch_models() -> Dict[str, Any]:
+    """Merged model list from every healthy Ollama backend"""
+    backends = balancer.candidates()
+    if not backends:
+        raise HTTPException(status_code=503, detail="No healthy Ollama backends available")
+    responses = await asyncio.gather(
+        *(upstream.get(f"{b.url}/api/tags") for b in backends), return_exceptions=True
+    )
+    models: Dict[str, Dict[str, Any]] = {}
+    errors = []
+    for backend, response in zip(backends, responses):
+        try:
+            if isinstance(response, Exception):
+                raise response
+            response.raise_for_status()
+            backend_models = response.json().get("models", [])
+        except Exception as e:
+            balancer.record_failure(backend)
+            errors.append(f"{backend.url}: {e}")
+            continue
+        backend.models = {model_tag(m["name"]) for m in backend_models}
+        for model in backend_models:
+            models.setdefault(model["name"], model)
+    if errors and not models:
+        raise HTTPException(status_code=500, detail=f"Error fetching models: {'; '.join(errors)}")
+    return {"models": list(models.values())}
+
+models_view = StaleWhileRevalidate(fetch_models, MODELS_CACHE_TTL, MODELS_CACHE_MAX_STALE)
+
 @app.get("/models")
-async def list_models():
-    """Get available models from Ollama"""
+async def list_models(http_request: Request):
+    """Get available models from every healthy Ollama backend"""
+    value, etag = await models_view.get()
+    return conditional_response(http_request, value, etag, MODELS_CACHE_TTL)
+
+def stream_format(http_request: Request) -> str:
+    """Clients asking for application/x-ndjson get Ollama's raw lines, everyone else SSE"""
+    return "ndjson" if "application/x-ndjson" in http_request.headers.get("accept", "") else "sse"
+
+def sse_frames(carry: bytes, chunk: bytes) -> tuple:
+    """Frame every complete NDJSON line in `carry + chunk` as SSE, working on bytes only"""
+    lines = (carry + chunk).split(b"\n") if carry else chunk.split(b"\n")
+    carry = lines.pop()
+    return b"".join(b"data: " + line + b"\n\n" for line in lines if line), carry
+
+def stream_to_client(endpoint: str, model: str, prompt_length: int, start_time: float, items: AsyncIterator[Any],
+                     fmt: str, api_key: Optional[str], queue_time: Callable[[], float] = lambda: 0.0,
+                     headers: Optional[Dict[str, str]] = None, raw: bool = False,
+                     watch: Optional[DisconnectWatch] = None, cached: bool = False) -> StreamingResponse:
+    """Relay upstream NDJSON to the client and log the request once the final line is sent.
+
+    `items` yields decoded lines, or with `raw` set, lists of upstream byte chunks.
+    A `cached` replay is logged with its response time only, as no generation ran.
+    """
+    async def line_body():
+        nonlocal first_at, last
+        async for line in items:
+            if first_at is None:
+                first_at = time.time()
+            last = line
+            yield f"data: {line}\n\n" if fmt == "sse" else f"{line}\n"
+
+    async def raw_body():
+        nonlocal first_at, last
+        tail = StreamTail()
+        carry = b""
+        async for chunks in items:
+            if first_at is None:
+                first_at = time.time()
+            for chunk in chunks:
+                tail.feed(chunk)
+            if fmt == "ndjson":
+                for chunk in chunks:
+                    yield chunk
+            elif STREAM_MODE == "batched":
+                frames, carry = sse_frames(carry, b"".join(chunks))
+                if frames:
+                    yield frames
+            else:
+                for chunk in chunks:
+                    frames, carry = sse_frames(carry, chunk)
+                    if frames:
+                        yield frames
+        if carry:
+            # Upstream ended without a final newline; the line is still complete
+            yield b"data: " + carry + b"\n\n"
+        last = tail.last_line()
+
+    first_at = None
+    last = None
+
+    async def body():
+        try:
+            async for frame in (raw_body() if raw else line_body()):
+                yield frame
+        finally:
+            if watch is not None:
+                watch.stop()
+        if watch is not None and watch.disconnected:
+            return
+        if cached:
+            log_request(endpoint, model, prompt_length, time.time() - start_time)
+            return
+        final = json_loads(last) if last is not None else None
+        await rate_limiter.charge_tokens(api_key, final)
+        log_request(endpoint, model, prompt_length, time.time() - start_time, queue_time(), final,
+                    ttft=first_at - start_time if first_at is not None else None)
+
+    media_type = "text/event-stream" if fmt == "sse" else "application/x-ndjson"
+    return StreamingResponse(body(), media_type=media_type, headers=headers)
+
+async def proxy_completion(endpoint: str, model: str, payload: Dict[str, Any], prompt_length: int,
+                           http_request: Request, api_key: Optional[str], session: Optional[Session] = None):
+    """Shared path for /generate and /chat: cache, coalescing, admission and upstream call"""
+    start_time = time.time()
+    stream = bool(payload.get("stream"))
+    # A session turn depends on stored history the payload does not show yet, so it is never cached or shared
+    cache_key = cache_key_for(endpoint, payload) if session is None else None
+    cached = response_cache.get_bytes(cache_key) if cache_key else None
+    
+    if cached is not None:
+        if stream:
+            # Cache hits cost no GPU time, so they are not charged against token quotas
+            return stream_to_client(endpoint, model, prompt_length, start_time,
+                                    replay_stream(endpoint, json_loads(cached)),
+                                    stream_format(http_request), None, headers={"X-Cache": "HIT"}, cached=True)
+        # The stored timings and token counts belong to the original call, so only the response time is logged
+        log_request(endpoint, model, prompt_length, time.time() - start_time)
+        return json_response(RawResult(cached), headers={"X-Cache": "HIT"})
+    
+    coalesce_key = coalesce_key_for(endpoint, payload) if session is None else None
+    priority = request_priority(http_request)
+    
+    if stream:
+        # Handle streaming response; relay bytes untouched unless lines are needed for the cache or session
+        fmt = stream_format(http_request)
+        raw = cache_key is None and session is None and STREAM_MODE != "lines"
+        if raw:
+            coalesce_key = raw_coalesce_key(coalesce_key)
+        flight = single_flight.subscribe(
+            coalesce_key, stream_upstream(endpoint, model, payload, cache_key, priority, raw, session))
+        # Only the subscriber that started the flight pays for its tokens, as one generation serves them all
+        charged_key = api_key if flight.subscribers == 1 else None
+        watch = DisconnectWatch(http_request, flight)
+        items = await open_stream(flight, batch=raw, watch=watch)
+        return stream_to_client(endpoint, model, prompt_length, start_time, items, fmt,
+                                charged_key, lambda: flight.queue_time, raw=raw, watch=watch)
+    
+    # Handle regular response
+    result = await complete(endpoint, model, payload, prompt_length, api_key, priority, start_time,
+                            cache_key, coalesce_key, http_request, session)
+    return json_response(result)
+
+async def complete(endpoint: str, model: str, payload: Dict[str, Any], prompt_length: int, api_key: Optional[str],
+                   priority: int, start_time: float, cache_key: Optional[str], coalesce_key: Optional[str],
+                   http_request: Optional[Request] = None, session: Optional[Session] = None) -> RawResult:
+    """Buffered upstream call through single-flight, with quota charging of the leader and logging"""
+    flight = single_flight.subscribe(coalesce_key,
+                                     fetch_upstream(endpoint, model, payload, cache_key, priority, session))
+    # Only the subscriber that started the flight pays for its tokens, as one generation serves them all
+    leader = flight.subscribers == 1
+    watch = DisconnectWatch(http_request, flight) if http_request is not None else None
+    result = await first_item(flight, watch)
+    if leader:
+        await rate_limiter.charge_tokens(api_key, result.stats)
+    
+    # Log request
+    response_time = time.time() - start_time
+    log_request(endpoint, model, prompt_length, response_time, flight.queue_time, result.stats)
+    
+    return result
+
+def parse_batch(body: bytes) -> List[Any]:
+    """Batch items from a JSON array or an NDJSON body"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{OLLAMA_BASE_URL}/api/tags")
-            response.raise_for_status()
-            return response.json()
+        items = json_loads(body)
+    except ValueError:
+        items = None
+    if isinstance(items, list):
+        return items
+    if isinstance(items, dict):
+        return [items]
+    items = []
+    for line in body.splitlines():
+        if line.strip():
+            try:
+                items.append(json_loads(line))
+            except ValueError as e:
+                items.append(e)  # reported against its index instead of failing the batch
+    return items
+
+def batch_line(index: int, result: RawResult, cached: bool = False) -> bytes:
+    """NDJSON line embedding the upstream body as-is"""
+    return b'{"index":%d,%s"result":%s}\n' % (index, b'"cached":true,' if cached else b"", result.body.strip())
+
+def batch_error(index: int, status: int, detail: Any) -> bytes:
+    line = json.dumps({"index": index, "error": {"status": status, "detail": detail}}, separators=(",", ":"))
+    return line.encode() + b"\n"
+
+async def generate_item(index: int, item: Any, api_key: Optional[str], priority: int, ip: str) -> bytes:
+    """Run one batch item as a non-streamed /generate; failures, including an exhausted quota, become its error"""
+    start_time = time.time()
+    try:
+        if isinstance(item, Exception):
+            raise HTTPException(status_code=400, detail=f"Invalid JSON: {item}")
+        try:
+            request = GenerateRequest.model_validate(item)
+        except ValidationError as e:
+            raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_context=False))
+        if request.session_id:
+            raise HTTPException(status_code=400, detail="Sessions cannot be used in a batch")
+        if RATE_LIMIT_ENABLED:
+            # Each item costs the same as a single /generate call, but waits for its turn instead of failing
+            await rate_limiter.pace(ip, api_key)
+        payload = request.to_payload()
+        payload["stream"] = False
+        await fit_context("generate", request.model, payload)
+        cache_key = cache_key_for("generate", payload)
+        cached = response_cache.get_bytes(cache_key) if cache_key else None
+        if cached is not None:
+            log_request("generate", request.model, len(payload["prompt"]), time.time() - start_time)
+            return batch_line(index, RawResult(cached), cached=True)
+        result = await complete("generate", request.model, payload, len(payload["prompt"]), api_key, priority,
+                                start_time, cache_key, coalesce_key_for("generate", payload))
+        return batch_line(index, result)
+    except HTTPException as e:
+        return batch_error(index, e.status_code, e.detail)
+    except httpx.HTTPStatusError as e:
+        return batch_error(index, e.response.status_code, e.response.text)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error fetching models: {str(e)}")
+        return batch_error(index, 500, f"Error generating text: {str(e)}")
+
+async def embed_texts(model: str, texts: List[str], fields: Dict[str, Any], api_key: Optional[str], priority: int,
+                      http_request: Optional[Request] = None) -> tuple:
+    """Vectors for `texts`, in order, and the upstream stats.
+
+    Repeated texts are embedded once, cached vectors are reused, and the rest
+    go upstream in batches of EMBED_BATCH_SIZE running concurrently.
+    """
+    start_time = time.time()
+    unique = list(dict.fromkeys(texts))
+    vectors: Dict[str, Any] = {}
+    keys: Dict[str, bytes] = {}
+    if vector_cache.enabled:
+        keys = {text: VectorCache.key(model, text, fields.get("dimensions")) for text in unique}
+        found = vector_cache.get_many(list(keys.values()))
+        vectors = {text: found[key] for text, key in keys.items() if key in found}
+    missing = [text for text in unique if text not in vectors]
+
+    async def fetch(chunk: List[str]) -> RawResult:
+        payload = dict(fields, model=model, input=chunk)
+        return await complete("embed", model, payload, sum(len(text) for text in chunk), api_key, priority,
+                              start_time, None, None, http_request)
+
+    batches = [missing[i:i + EMBED_BATCH_SIZE] for i in range(0, len(missing), EMBED_BATCH_SIZE)]
+    prompt_tokens = 0
+    for chunk, result in zip(batches, await asyncio.gather(*(fetch(chunk) for chunk in batches))):
+        embeddings = json_loads(result.body)["embeddings"]
+        prompt_tokens += result.stats.get("prompt_eval_count") or 0
+        if vector_cache.enabled:
+            vector_cache.put_many(model, [keys[text] for text in chunk], embeddings)
+        vectors.update(zip(chunk, embeddings))
+    if not batches:
+        log_request("embed", model, sum(len(text) for text in unique), time.time() - start_time)
+    stats = {"prompt_eval_count": prompt_tokens, "cached": len(unique) - len(missing),
+             "deduplicated": len(texts) - len(unique)}
+    return [vectors[text] for text in texts], stats
+
+def dumps_vectors(body: Dict[str, Any]) -> bytes:
+    """JSON for a body holding vectors that may be numpy rows"""
+    if orjson is not None:
+        return orjson.dumps(body, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(body, default=lambda value: value.tolist()).encode()
+
+def find_session(session_id: Optional[str], api_key: Optional[str]) -> Optional[Session]:
+    if session_id is None:
+        return None
+    session = sessions.get(session_id)
+    # With API keys enforced a session belongs to the key that created it; other keys see no such session
+    if session is None or (API_KEYS and session.api_key != api_key):
+        raise HTTPException(status_code=404, detail="Session not found or expired")
+    return session
 
 @app.post("/generate")
-async def generate_text(request: GenerateRequest):
+async def generate_text(request: GenerateRequest, http_request: Request, api_key: Optional[str] = Depends(rate_limit)):
     """Generate text using Ollama"""
-    start_time = time.time()
-    
     try:
-        payload = request.dict()
-        
-        if request.stream:
-            # Handle streaming response
-            async def stream_generator():
-                async with httpx.AsyncClient(timeout=REQUEST_TIMEOUT) as client:
-                    async with client.stream("POST", f"{OLLAMA_BASE_URL}/api/generate", json=payload) as response:
-                        response.raise_for_status()
-                        async for line in response.aiter_lines():
-                            if line:
-                                yield f"data: {line}\n\n"
-            
-            return StreamingResponse(stream_generator(), media_type="text/event-stream")
-        else:
-            # Handle regular response
-            async with httpx.AsyncClient(timeout=REQUEST_TIMEOUT) as client:
-                response = await client.post(f"{OLLAMA_BASE_URL}/api/generate", json=payload)
-                response.raise_for_status()
-                result = response.json()
-                
-                # Log request
-                response_time = time.time() - start_time
-                log_request("generate", request.model, len(request.prompt), response_time)
-                
-                return result
-                
+        payload = request.to_payload()
+        session = find_session(request.session_id, api_key)
+        if session is None:  # session turns are checked once their history is added
+            await fit_context("generate", request.model, payload)
+        return await proxy_completion("generate", request.model, payload, len(payload["prompt"]), http_request,
+                                      api_key, session)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating text: {str(e)}")
 
+@app.post("/generate/batch")
+async def generate_batch(http_request: Request, api_key: Optional[str] = Depends(authenticate)):
+    """Run many /generate requests with bounded concurrency.
+
+    Accepts a JSON array or NDJSON body of GenerateRequest objects and streams
+    one NDJSON line per item, in completion order, tagged with its input index.
+    Each item is rate limited like a single /generate call, waiting for the
+    limit to allow it; only items over the token quota come back as 429 errors.
+    """
+    items = parse_batch(await http_request.body())
+    if not items:
+        raise HTTPException(status_code=400, detail="Batch is empty")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Batch exceeds {BATCH_MAX_ITEMS} items")
+    priority = request_priority(http_request)
+    ip = client_ip(http_request)
+    
+    async def body():
+        pending = iter(enumerate(items))
+        done: asyncio.Queue = asyncio.Queue()
+        
+        async def worker():
+            for index, item in pending:
+                await done.put(await generate_item(index, item, api_key, priority, ip))
+        
+        workers = [asyncio.create_task(worker()) for _ in range(min(BATCH_CONCURRENCY, len(items)))]
+        try:
+            for _ in range(len(items)):
+                yield await done.get()
+        finally:
+            # Client went away or the batch finished; either way stop any work still running
+            for task in workers:
+                task.cancel()
+    
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
+@app.post("/embed")
+async def embed(request: EmbedRequest, http_request: Request, api_key: Optional[str] = Depends(rate_limit)):
+    """Embed one text or a batch of them with Ollama's embed API.
+
+    The response has Ollama's shape plus `cached` (inputs served from the
+    vector cache) and `deduplicated` (repeated inputs embedded once).
+    """
+    texts = [request.input] if isinstance(request.input, str) else request.input
+    if len(texts) > EMBED_MAX_INPUTS:
+        raise HTTPException(status_code=413, detail=f"Request exceeds {EMBED_MAX_INPUTS} inputs")
+    fields = request.model_dump(exclude_none=True, exclude={"model", "input"})
+    try:
+        embeddings, stats = await embed_texts(request.model, texts, fields, api_key,
+                                              request_priority(http_request), http_request)
+    except HTTPException:
+        raise
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error embedding: {str(e)}")
+    return Response(dumps_vectors({"model": request.model, "embeddings": embeddings, **stats}),
+                    media_type="application/json")
+
+def rag_prompt(question: str, chunks: List[Dict[str, Any]]) -> str:
+    context = "\n\n".join(f"[{i}] {chunk['text']}" for i, chunk in enumerate(chunks, 1))
+    return (f"Answer the question using the numbered context passages below, citing them as [n]. "
+            f"If they do not contain the answer, say so.\n\nContext:\n{context}\n\nQuestion: {question}")
+
+def require_retrieval():
+    if not retrieval.enabled:
+        raise HTTPException(status_code=503, detail="Retrieval is disabled (needs numpy and PROXY_RAG_DIR)")
+
+@app.post("/rag/index")
+async def rag_index(request: RagIndexRequest, http_request: Request, api_key: Optional[str] = Depends(rate_limit)):
+    """Chunk, embed and add documents to a retrieval index, creating it on first use"""
+    require_retrieval()
+    try:
+        return await retrieval.add(request.index, request.model, request.documents, request.chunk_chars,
+                                   request.chunk_overlap, api_key, request_priority(http_request), http_request)
+    except HTTPException:
+        raise
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error indexing documents: {str(e)}")
+
+@app.post("/rag/query")
+async def rag_query(request: RagQueryRequest, http_request: Request, api_key: Optional[str] = Depends(rate_limit)):
+    """Answer a /generate request from the index's most similar chunks.
+
+    Sources are listed in the X-RAG-Sources header as comma-separated,
+    percent-encoded document ids, best first.
+    """
+    require_retrieval()
+    index = retrieval.index(request.index)
+    if index is None:
+        raise HTTPException(status_code=404, detail=f"Index '{request.index}' not found")
+    try:
+        (vector,), _ = await embed_texts(index.model, [request.prompt], {}, api_key,
+                                         request_priority(http_request), http_request)
+        chunks = retrieval.query(index, vector, request.top_k)
+        # Built before generating: ids may hold any character, and a bad header must not waste a generation
+        sources = ",".join(quote(doc_id, safe="") for doc_id in dict.fromkeys(chunk["document"] for chunk in chunks))
+        payload = request.to_payload()
+        payload["prompt"] = rag_prompt(request.prompt, chunks)
+        if not request.generate:
+            return {"index": request.index, "chunks": chunks, "prompt": payload["prompt"]}
+        session = find_session(request.session_id, api_key)
+        if session is None:
+            await fit_context("generate", request.model, payload)
+        response = await proxy_completion("generate", request.model, payload, len(payload["prompt"]), http_request,
+                                          api_key, session)
+    except HTTPException:
+        raise
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error in retrieval: {str(e)}")
+    response.headers["X-RAG-Sources"] = sources
+    return response
+
 @app.post("/chat")
-async def chat_with_model(request: ChatRequest):
+async def chat_with_model(request: ChatRequest, http_request: Request, api_key: Optional[str] = Depends(rate_limit)):
     """Chat with model using conversation history"""
-    start_time = time.time()
-    
     try:
-        payload = request.dict()
-        
-        async with httpx.AsyncClient(timeout=REQUEST_TIMEOUT) as client:
-            response = await client.post(f"{OLLAMA_BASE_URL}/api/chat", json=payload)
-            response.raise_for_status()
-            result = response.json()
-            
-            # Log request
-            response_time = time.time() - start_time
-            prompt_length = sum(len(msg.content) for msg in request.messages)
-            log_request("chat", request.model, prompt_length, response_time)
-            
-            return result
-            
+        payload = request.to_payload()
+        session = find_session(request.session_id, api_key)
+        if session is None:  # session turns are checked once their history is added
+            await fit_context("chat", request.model, payload)
+        prompt_length = sum(len(msg.get("content", "")) for msg in payload["messages"])
+        return await proxy_completion("chat", request.model, payload, prompt_length, http_request, api_key, session)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error in chat: {str(e)}")
 
-@app.get("/stats")
-async def get_stats():
-    """Get server statistics"""
+@app.post("/sessions", status_code=201)
+async def create_session(request: SessionRequest, api_key: Optional[str] = Depends(rate_limit)):
+    """Start a conversation; pass its id as `session_id` to /chat or /generate to continue it"""
+    session = sessions.create(request.model, request.token_budget, request.summarize, request.system, api_key)
+    return {"id": session.id, "ttl": sessions.ttl, "token_budget": session.token_budget or None,
+            "summarize": session.summarize}
+
+@app.get("/sessions/{session_id}")
+async def get_session(session_id: str, messages: bool = False, api_key: Optional[str] = Depends(authenticate)):
+    """A conversation's backend, size and prompt evaluation saved by reusing its prefix"""
+    return find_session(session_id, api_key).info(include_messages=messages)
+
+@app.delete("/sessions/{session_id}")
+async def delete_session(session_id: str, api_key: Optional[str] = Depends(authenticate)):
+    find_session(session_id, api_key)
+    if not sessions.delete(session_id):
+        raise HTTPException(status_code=404, detail="Session not found or expired")
+    return {"id": session_id, "deleted": True}
+
+@app.post("/jobs", status_code=202)
+async def submit_job(job: JobRequest, http_request: Request, api_key: Optional[str] = Depends(rate_limit)):
+    """Queue a generate or chat request to run in the background"""
+    model_cls = ChatRequest if job.endpoint == "chat" else GenerateRequest
+    try:
+        request = model_cls.model_validate(job.request)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_context=False))
+    if request.session_id:
+        raise HTTPException(status_code=400, detail="Sessions cannot be used with background jobs")
+    payload = request.to_payload()
+    await fit_context(job.endpoint, request.model, payload)
+    job_id = jobs.submit(job.endpoint, payload, api_key, request_priority(http_request))
+    return {"id": job_id, "status": "queued", "status_url": f"/jobs/{job_id}", "stream_url": f"/jobs/{job_id}/stream"}
+
+def find_job(job_id: str, api_key: Optional[str]) -> Dict[str, Any]:
+    job = jobs.get(job_id)
+    # With API keys enforced a job belongs to the key that submitted it; other keys see no such job
+    if job is None or (API_KEYS and jobs.submitter(job_id) != api_key):
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, api_key: Optional[str] = Depends(authenticate)):
+    """Status, and once finished the result or error, of a queued job"""
+    return find_job(job_id, api_key)
+
+@app.get("/jobs/{job_id}/stream")
+async def stream_job(job_id: str, http_request: Request, api_key: Optional[str] = Depends(authenticate)):
+    """Attach to a job's tokens: replays what was generated so far, then follows it live"""
+    find_job(job_id, api_key)
+    fmt = stream_format(http_request)
+    
+    async def lines():
+        while job_id not in jobs.live:
+            current = jobs.get(job_id)
+            if current is None or current["status"] not in ("queued", "running"):
+                break
+            await asyncio.sleep(0.25)
+        live = jobs.live.get(job_id)
+        if live is not None:
+            sent = 0
+            while True:
+                async with live.changed:
+                    await live.changed.wait_for(lambda: live.done or len(live.lines) > sent)
+                    pending, done = live.lines[sent:], live.done
+                sent += len(pending)
+                for line in pending:
+                    yield line
+                if done:
+                    break
+            if sent:
+                # The tokens are out; only a failure still needs reporting, or the stream reads as complete
+                error = (jobs.get(job_id) or {}).get("error")
+                if error is not None:
+                    yield json.dumps({"error": error, "done": True})
+                return
+        # Finished before or while we waited: replay the stored outcome
+        current = jobs.get(job_id) or {}
+        if "result" in current:
+            async for line in replay_stream(current["endpoint"], current["result"]):
+                yield line
+        elif "error" in current:
+            yield json.dumps({"error": current["error"], "done": True})
+    
+    async def body():
+        async for line in lines():
+            yield f"data: {line}\n\n" if fmt == "sse" else f"{line}\n"
+    
+    media_type = "text/event-stream" if fmt == "sse" else "application/x-ndjson"
+    return StreamingResponse(body(), media_type=media_type)
+
+def collect_stats() -> Dict[str, Any]:
+    """This worker's statistics"""
+    components = {
+        "upstream_pool": upstream.stats(),
+        "load_balancer": balancer.stats(),
+        "residency": residency.stats(),
+        "response_cache": response_cache.stats(),
+        "models_cache": models_view.stats(),
+        "single_flight": single_flight.stats(),
+        "admission": scheduler.stats(),
+        "rate_limits": rate_limiter.stats(),
+        "latency": latency_stats.stats(),
+        "streams": stream_stats.stats(),
+        "micro_batching": batcher.stats(),
+        "tokens": token_counter.stats(),
+        "jobs": jobs.stats(),
+        "sessions": sessions.stats(),
+        "embedding_cache": vector_cache.stats(),
+        "retrieval": retrieval.stats(),
+    }
     if not request_log:
-        return {"message": "No requests logged yet"}
+        return {"message": "No requests logged yet", **components}
     
     total_requests = len(request_log)
-    avg_response_time = sum(req["response_time"] for req in request_log) / total_requests
-    
-    models_used = {}
-    for req in request_log:
-        model = req["model"]
-        models_used[model] = models_used.get(model, 0) + 1
     
     return {
         "total_requests": total_requests,
-        "average_response_time": round(avg_response_time, 2),
-        "models_used": models_used,
-        "recent_requests": request_log[-5:]  # Last 5 requests
+        "lifetime_requests": request_log.lifetime_requests,
+        "window_size": request_log.capacity,
+        "average_response_time": round(request_log.total_response_time / total_requests, 2),
+        "average_queue_time": round(request_log.total_queue_time / total_requests, 3),
+        "prompt_tokens": request_log.total_prompt_tokens,
+        "completion_tokens": request_log.total_completion_tokens,
+        "models_used": dict(request_log.models_used),
+        "recent_requests": request_log.recent(5),  # Last 5 requests
+        **components
     }
 
+@app.get("/stats")
+async def get_stats():
+    """Get server statistics, merged across workers in multi-worker mode"""
+    if shared_state.enabled:
+        return shared_state.merge_stats(collect_stats())
+    return collect_stats()
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus text exposition of proxy metrics"""
+    text = shared_state.merge_metrics(metrics.render()) if shared_state.enabled else metrics.render()
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4; charset=utf-8")
+
 if __name__ == "__main__":
+    import argparse
+    import tempfile
     import uvicorn
+    parser = argparse.ArgumentParser(description="Ollama Proxy Server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes sharing stats, limits and cache")
+    args = parser.parse_args()
+    
     print("🚀 Starting Ollama Proxy Server...")
-    print(f"📡 Proxying to: {OLLAMA_BASE_URL}")
-    print("🌐 Web interface: http://localhost:8000/web")
-    print("📚 API docs: http://localhost:8000/docs")
+    print(f"📡 Proxying to: {', '.join(OLLAMA_BACKENDS)}")
+    print(f"🌐 Web interface: http://localhost:{args.port}/web")
+    print(f"📚 API docs: http://localhost:{args.port}/docs")
     
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    if args.workers > 1:
+        # Workers re-import this module, so they pick the shared database up from the environment
+        shared_db = SHARED_STATE_DB or os.path.join(tempfile.gettempdir(), f"ollama-proxy-{args.port}.db")
+        os.environ["PROXY_SHARED_STATE_DB"] = shared_db
+        print(f"👥 {args.workers} workers sharing state through {shared_db}")
+        uvicorn.run("proxy_server:app", host=args.host, port=args.port, workers=args.workers)
+    else:
+        uvicorn.run(app, host=args.host, port=args.port)
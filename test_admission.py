@@ -0,0 +1,93 @@
+"""Tests for AdmissionScheduler (no network or upstream needed)"""
+
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from proxy_server import AdmissionScheduler
+
+def run(coro):
+    return asyncio.run(coro)
+
+async def hold(scheduler: AdmissionScheduler, model: str, release: asyncio.Event, log: list, priority: int = 0):
+    async with scheduler.slot(model, priority) as queue_time:
+        log.append((model, priority, queue_time))
+        await release.wait()
+
+def test_idle_model_is_not_queued_behind_another_models_backlog():
+    async def scenario():
+        scheduler = AdmissionScheduler(global_limit=4, model_limit=1, max_depth=10, policy="fifo", timeout=5)
+        release, log = asyncio.Event(), []
+        first = asyncio.create_task(hold(scheduler, "a", release, log))
+        waiting = asyncio.create_task(hold(scheduler, "a", release, log))
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth == 1  # the second "a" request waits for a's per-model slot
+        async with scheduler.slot("b") as queue_time:
+            assert queue_time < 0.05
+            assert scheduler.active_by_model == {"a": 1, "b": 1}
+        release.set()
+        await asyncio.gather(first, waiting)
+        assert scheduler.active == 0 and scheduler.queue_depth == 0
+    run(scenario())
+
+def test_freed_slot_goes_to_best_ranked_eligible_waiter():
+    async def scenario():
+        scheduler = AdmissionScheduler(global_limit=1, model_limit=1, max_depth=10, policy="priority", timeout=5)
+        gates = {name: asyncio.Event() for name in ("first", "low", "high")}
+        log = []
+        first = asyncio.create_task(hold(scheduler, "a", gates["first"], log))
+        await asyncio.sleep(0)
+        low = asyncio.create_task(hold(scheduler, "b", gates["low"], log, priority=5))
+        high = asyncio.create_task(hold(scheduler, "c", gates["high"], log, priority=1))
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth == 2
+        gates["first"].set()
+        await first
+        await asyncio.sleep(0.01)
+        assert [entry[:2] for entry in log] == [("a", 0), ("c", 1)]
+        gates["high"].set()
+        gates["low"].set()
+        await asyncio.gather(low, high)
+        assert [entry[:2] for entry in log][-1] == ("b", 5)
+    run(scenario())
+
+def test_full_queue_is_rejected_with_retry_after():
+    async def scenario():
+        scheduler = AdmissionScheduler(global_limit=1, model_limit=1, max_depth=1, policy="fifo", timeout=5)
+        release, log = asyncio.Event(), []
+        tasks = [asyncio.create_task(hold(scheduler, "a", release, log)) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as rejected:
+            async with scheduler.slot("a"):
+                pass
+        assert rejected.value.status_code == 429
+        assert "Retry-After" in rejected.value.headers
+        release.set()
+        await asyncio.gather(*tasks)
+    run(scenario())
+
+def test_timed_out_and_cancelled_waiters_leave_the_queue():
+    async def scenario():
+        scheduler = AdmissionScheduler(global_limit=1, model_limit=1, max_depth=10, policy="fifo", timeout=0.05)
+        release, log = asyncio.Event(), []
+        holder = asyncio.create_task(hold(scheduler, "a", release, log))
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as timed_out:
+            async with scheduler.slot("a"):
+                pass
+        assert timed_out.value.status_code == 503
+        cancelled = asyncio.create_task(hold(scheduler, "a", release, log))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        assert scheduler.queue_depth == 0
+        release.set()
+        await holder
+        assert scheduler.active == 0
+        # The abandoned waiters must not hold up the next request for the same model
+        async with scheduler.slot("a") as queue_time:
+            assert queue_time < 0.05
+        assert scheduler.rejected_timeout == 1
+    run(scenario())
@@ -0,0 +1,24 @@
+"""Tests for LoadBalancer model-aware routing (no network or upstream needed)"""
+
+from proxy_server import LoadBalancer
+
+def balancer_with(models_by_url: dict) -> LoadBalancer:
+    balancer = LoadBalancer(list(models_by_url))
+    for backend in balancer.backends:
+        backend.models = models_by_url[backend.url]
+    return balancer
+
+def test_untagged_request_matches_latest_tag():
+    balancer = balancer_with({"http://a": {"llama3:latest"}, "http://b": {"mistral:latest"}})
+    assert [b.url for b in balancer.candidates("llama3")] == ["http://a"]
+    assert [b.url for b in balancer.candidates("llama3:latest")] == ["http://a"]
+
+def test_other_tags_do_not_match_and_unknown_models_use_every_backend():
+    balancer = balancer_with({"http://a": {"llama3:8b"}, "http://b": {"mistral:latest"}})
+    assert [b.url for b in balancer.candidates("llama3")] == ["http://a", "http://b"]
+    assert [b.url for b in balancer.candidates("llama3:8b")] == ["http://a"]
+
+def test_unhealthy_backends_are_skipped():
+    balancer = balancer_with({"http://a": {"llama3:latest"}, "http://b": {"llama3:latest"}})
+    balancer.backends[0].healthy = False
+    assert [b.url for b in balancer.candidates("llama3")] == ["http://b"]
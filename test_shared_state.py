@@ -0,0 +1,18 @@
+"""Tests for merging per-worker /stats snapshots (no network or upstream needed)"""
+
+from proxy_server import SharedState
+
+def test_component_counters_are_summed_and_settings_taken_once():
+    workers = [
+        {"admission": {"global_limit": 32, "admitted": 3, "avg_service_time": 0.5, "policy": "fifo"},
+         "load_balancer": {"backends": [{"url": "u", "total_requests": 2, "last_probe": 1.0}]},
+         "upstream_pool": {"peak_in_flight": 3}},
+        {"admission": {"global_limit": 32, "admitted": 4, "avg_service_time": 0.7, "policy": "fifo"},
+         "load_balancer": {"backends": [{"url": "u", "total_requests": 5, "last_probe": 2.0}]},
+         "upstream_pool": {"peak_in_flight": 5}},
+    ]
+    merged = {name: SharedState._merge(name, [w[name] for w in workers]) for name in workers[0]}
+    # Averages that differ between workers are only reported per worker
+    assert merged["admission"] == {"global_limit": 32, "admitted": 7, "policy": "fifo"}
+    assert merged["load_balancer"] == {"backends": [{"url": "u", "total_requests": 7}]}
+    assert merged["upstream_pool"] == {"peak_in_flight": 5}
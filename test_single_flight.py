@@ -0,0 +1,140 @@
+"""Tests for Flight and SingleFlight (no network or upstream needed)"""
+
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from proxy_server import Flight, SingleFlight
+
+def run(coro):
+    return asyncio.run(coro)
+
+def test_concurrent_subscribers_share_one_producer():
+    async def scenario():
+        single_flight = SingleFlight()
+        calls = []
+
+        async def producer(flight: Flight):
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            flight.publish("result")
+
+        flights = [single_flight.subscribe("key", producer) for _ in range(3)]
+        assert flights[0] is flights[1] is flights[2]
+        results = await asyncio.gather(*(collect(flight) for flight in flights))
+        assert results == [["result"]] * 3
+        assert calls == [1]
+        assert single_flight.followers == 2
+        # Finished flights are forgotten, so the next request starts a new call
+        assert single_flight.subscribe("key", producer) is not flights[0]
+    run(scenario())
+
+async def collect(flight: Flight) -> list:
+    return [item async for item in flight.iterate()]
+
+def test_slow_subscriber_throttles_the_producer_and_consumed_items_are_trimmed():
+    async def scenario():
+        flight = Flight(max_buffered=4)
+        produced = []
+
+        async def producer():
+            for i in range(40):
+                flight.publish(i)
+                produced.append(i)
+                await flight.wait_writable()
+            flight.finish()
+
+        flight.subscribers = 1
+        items = flight.iterate()
+        first = asyncio.create_task(items.__anext__())  # registers the reader before anything is published
+        await asyncio.sleep(0)
+        task = asyncio.create_task(producer())
+        received = [await first]
+        await asyncio.sleep(0.01)
+        # The producer stalls once it is max_buffered items ahead of the reader
+        assert len(produced) - len(received) <= 4
+        async for item in items:
+            received.append(item)
+            assert len(flight.items) < 2 * flight.max_buffered
+            await asyncio.sleep(0)
+        await task
+        assert received == list(range(40))
+        assert flight.trimmed and flight.base > 0
+    run(scenario())
+
+def test_trimmed_flight_is_not_joined():
+    async def scenario():
+        single_flight = SingleFlight()
+        release = asyncio.Event()
+
+        async def producer(flight: Flight):
+            for i in range(10):
+                flight.publish(i)
+                await flight.wait_writable()
+            await release.wait()
+
+        flight = single_flight.subscribe("key", producer)
+        flight.max_buffered = 2
+        items = flight.iterate()
+        for _ in range(8):
+            await items.__anext__()
+        assert flight.trimmed  # a late joiner could no longer replay the sequence from the start
+        late = single_flight.subscribe("key", producer)
+        assert late is not flight
+        release.set()
+        await items.aclose()
+        await collect(late)
+    run(scenario())
+
+def test_upstream_is_cancelled_only_when_the_last_subscriber_leaves():
+    async def scenario():
+        single_flight = SingleFlight()
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+
+        async def producer(flight: Flight):
+            flight.publish("first")
+            started.set()
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        flights = [single_flight.subscribe("key", producer) for _ in range(2)]
+        readers = [flight.iterate() for flight in flights]
+        for reader in readers:
+            assert await reader.__anext__() == "first"
+        await started.wait()
+
+        await readers[0].aclose()
+        await asyncio.sleep(0)
+        assert not cancelled.is_set()
+
+        await readers[1].aclose()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        await asyncio.sleep(0)
+        flight = flights[0]
+        assert flight.done
+        assert isinstance(flight.error, HTTPException) and flight.error.status_code == 499
+        # A cancelled flight no longer answers new subscribers for its key
+        assert single_flight.subscribe("key", producer) is not flight
+    run(scenario())
+
+def test_producer_error_reaches_every_subscriber():
+    async def scenario():
+        single_flight = SingleFlight()
+
+        async def producer(flight: Flight):
+            flight.publish("partial")
+            raise RuntimeError("upstream failed")
+
+        flights = [single_flight.subscribe("key", producer) for _ in range(2)]
+        for flight in flights:
+            received = []
+            with pytest.raises(RuntimeError):
+                async for item in flight.iterate():
+                    received.append(item)
+            assert received == ["partial"]
+    run(scenario())
@@ -0,0 +1,45 @@
+"""Tests for the streaming relay's SSE framing (no network or upstream needed)"""
+
+import asyncio
+
+import pytest
+
+import proxy_server
+
+async def chunk_lists(*lists):
+    for chunks in lists:
+        yield chunks
+
+def relay(monkeypatch, mode: str, fmt: str, *lists) -> bytes:
+    monkeypatch.setattr(proxy_server, "STREAM_MODE", mode)
+
+    async def scenario():
+        response = proxy_server.stream_to_client("generate", "m", 0, 0.0, chunk_lists(*lists), fmt, None, raw=True)
+        return b"".join([frame async for frame in response.body_iterator])
+    return asyncio.run(scenario())
+
+@pytest.mark.parametrize("mode", ["raw", "batched"])
+def test_sse_frames_lines_split_across_chunks(monkeypatch, mode):
+    body = relay(monkeypatch, mode, "sse",
+                 [b'{"response":"a",', b'"done":false}\n{"res'], [b'ponse":"","done":true}\n'])
+    assert body == b'data: {"response":"a","done":false}\n\ndata: {"response":"","done":true}\n\n'
+
+@pytest.mark.parametrize("mode", ["raw", "batched"])
+def test_sse_relays_final_line_without_newline(monkeypatch, mode):
+    body = relay(monkeypatch, mode, "sse", [b'{"response":"a","done":false}\n'], [b'{"response":"","done":true}'])
+    assert body.endswith(b'data: {"response":"","done":true}\n\n')
+
+def test_ndjson_relays_bytes_unchanged(monkeypatch):
+    chunks = [b'{"response":"a","done":false}\n{"resp', b'onse":"","done":true}']
+    assert relay(monkeypatch, "raw", "ndjson", chunks) == b"".join(chunks)
+
+def test_stream_tail_keeps_only_the_last_line():
+    tail = proxy_server.StreamTail()
+    for i in range(10000):
+        tail.feed(b'{"response":"%d","done":false}\n' % i)
+    tail.feed(b'{"response":"","do')
+    tail.feed(b'ne":true}\n')
+    assert len(tail.pending) == 0 and len(tail.line) < 64
+    assert tail.last_line() == b'{"response":"","done":true}'
+    tail.feed(b'{"partial"')
+    assert tail.last_line() == b'{"partial"'